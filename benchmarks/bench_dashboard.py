@@ -0,0 +1,191 @@
+#headless benchmark of dashboard.py: rerun latency, memory and payload size per page and widget value
+#
+#   python benchmarks/bench_dashboard.py --output report.json
+#   python benchmarks/bench_dashboard.py --baseline benchmarks/baseline.json
+#   python benchmarks/bench_dashboard.py --save-baseline benchmarks/baseline.json
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from streamlit.testing.v1 import AppTest
+
+from figures import figure_cache_stats
+from instrumentation import cache_stats
+
+
+PAGES = ['Introduction', 'Datasets', 'Clustering intro', 'Analysis and results', 'Conclusion', 'References']
+
+# selectbox label -> widget name in dashboard.py
+WIDGETS = {
+    'Variable': 'choice',
+    'Variable ': 'choice2',
+    'Variable:': 'choice3',
+    'State': 'choice4',
+    'Variable or cluster:': 'choice5',
+    'Tract variable': 'choice6',
+    'Area': 'choice7',
+    'Variable for hot spots:': 'choice8',
+    'Neighbours:': 'choice9',
+}
+
+# element types whose serialized size is recorded
+PAYLOAD_ELEMENTS = ['plotly_chart', 'image', 'table', 'arrow_data_frame', 'deck_gl_json_chart']
+
+# a step regresses when it exceeds the baseline by both the ratio and the absolute margin
+THRESHOLDS = {
+    'seconds': (1.5, 0.05),
+    'peak_rss_kb': (1.2, 20_000),
+    'payload_bytes': (1.1, 1_000),
+}
+
+
+def _rss_kb():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+def _reset_peak_rss():
+    # Linux: writing 5 to clear_refs resets the VmHWM high-water mark
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_kb():
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+    return None
+
+
+def _payloads(at):
+    sizes = {}
+    for kind in PAYLOAD_ELEMENTS:
+        elements = at.get(kind)
+        if elements:
+            sizes[kind] = [element.proto.ByteSize() for element in elements]
+    return sizes
+
+
+def _cache_deltas(before, after):
+    # hits and misses of each cached loader and on-disk cache during one step
+    deltas = {}
+    for name, counts in after.items():
+        old = before.get(name, {'hits': 0, 'misses': 0})
+        delta = {outcome: counts[outcome] - old[outcome] for outcome in ('hits', 'misses')}
+        if any(delta.values()):
+            deltas[name] = delta
+    return deltas
+
+
+def _run(at, step, report):
+    before = figure_cache_stats()
+    caches_before = cache_stats()
+    # peak RSS of this step only; None where the high-water mark cannot be reset
+    reset = _reset_peak_rss()
+    started = time.perf_counter()
+    at.run()
+    seconds = time.perf_counter() - started
+    if at.exception:
+        raise RuntimeError(f'{step} raised: {at.exception[0].message}')
+    after = figure_cache_stats()
+    caches = _cache_deltas(caches_before, cache_stats())
+    payloads = _payloads(at)
+    report.append({
+        'step': step,
+        'seconds': seconds,
+        'rss_kb': _rss_kb(),
+        'peak_rss_kb': _peak_rss_kb() if reset else None,
+        'figure_cache_hits': after['hits'] - before['hits'],
+        'figure_cache_misses': after['misses'] - before['misses'],
+        # st.cache_resource loaders and the on-disk k-means, weights, tile, index and table caches
+        'cache_misses': sum(delta['misses'] for delta in caches.values()),
+        'caches': caches,
+        'payloads': payloads,
+        'payload_bytes': sum(sum(sizes) for sizes in payloads.values()),
+    })
+
+
+def run_benchmark(timeout=120):
+    '''Drive the app through every page and every selectbox value, one rerun per step.'''
+    os.chdir(ROOT)
+    at = AppTest.from_file(os.path.join(ROOT, 'dashboard.py'), default_timeout=timeout)
+    steps = []
+    _run(at, 'start', steps)
+    for page in PAGES:
+        at.sidebar.radio[0].set_value(page)
+        _run(at, page, steps)
+        for label, widget in WIDGETS.items():
+            boxes = [box for box in at.selectbox if box.label == label]
+            if not boxes:
+                continue
+            initial = boxes[0].value
+            for value in boxes[0].options:
+                [box for box in at.selectbox if box.label == label][0].set_value(value)
+                _run(at, f'{page}/{widget}={value}', steps)
+            [box for box in at.selectbox if box.label == label][0].set_value(initial)
+    return {
+        'meta': {'python': platform.python_version(), 'machine': platform.machine(),
+                 'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                 # peak RSS of the whole run (Linux reports kilobytes)
+                 'process_peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss},
+        'steps': steps,
+    }
+
+
+def compare(report, baseline, thresholds=THRESHOLDS):
+    '''Steps whose metrics regressed beyond the thresholds, as readable messages.'''
+    previous = {step['step']: step for step in baseline['steps']}
+    regressions = []
+    for step in report['steps']:
+        old = previous.get(step['step'])
+        if old is None:
+            continue
+        for metric, (ratio, margin) in thresholds.items():
+            if step.get(metric) is None or old.get(metric) is None:
+                continue
+            if step[metric] > old[metric] * ratio and step[metric] - old[metric] > margin:
+                regressions.append(f"{step['step']}: {metric} {old[metric]:.3f} -> {step[metric]:.3f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark dashboard.py reruns headlessly.")
+    parser.add_argument('--output', help='write the report to this JSON file')
+    parser.add_argument('--baseline', help='compare against this report and fail on regressions')
+    parser.add_argument('--save-baseline', help='write the report as the new baseline')
+    args = parser.parse_args()
+
+    report = run_benchmark()
+    for path in [args.output, args.save_baseline]:
+        if path:
+            with open(path, 'w') as outfile:
+                json.dump(report, outfile, indent=1)
+
+    slowest = sorted(report['steps'], key=lambda step: step['seconds'], reverse=True)[:5]
+    for step in slowest:
+        missed = ', '.join(name for name, delta in step['caches'].items() if delta['misses'])
+        print(f"{step['seconds']:8.3f}s {step['payload_bytes'] / 1024:10.1f} KiB  {step['step']}"
+              + (f'  (cache misses: {missed})' if missed else ''))
+
+    if args.baseline:
+        with open(args.baseline) as infile:
+            regressions = compare(report, json.load(infile))
+        for regression in regressions:
+            print('REGRESSION', regression)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
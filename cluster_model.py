@@ -0,0 +1,213 @@
+#persisted k-means model: score new or changed counties without refitting everything
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from datastore import STORE_DIR, load_frame, save_frame, temp_path
+from instrumentation import count_cache
+from kmeans import (FEATURES, NUMERIC_FEATURES, STATS_COLUMNS, assign, cached_fit, feature_matrix,
+                    prepare_features, standardize)
+
+
+MODEL_PATH = os.path.join(STORE_DIR, 'cluster_model.json')
+ASSIGNMENTS = 'cluster_assignments'
+
+# refit when the counties scored into a cluster sit this much further from its centroid
+# than its members did at fit time (only judged for clusters with MIN_SCORED of them),
+DISTANCE_DRIFT = 1.5
+MIN_SCORED = 30
+# when a centroid recomputed from its current members moved this far (in units of the
+# fit-time RMS distance to the centroids),
+CENTROID_DRIFT = 0.5
+# or when this share of the counties changed since the last full fit
+CHANGED_SHARE = 0.2
+
+UpdateResult = namedtuple('UpdateResult', ['scored', 'moved', 'removed', 'needs_refit', 'drift'])
+
+
+class ClusterModel:
+    '''Scaler parameters, centroids and per-cluster aggregates of a k-means fit.
+
+    The model keeps each county's features (missing values as NaN, at the
+    table's precision) and cluster in the assignments table, so update()
+    only scores counties whose features changed and adjusts the per-cluster
+    counts and sums by their difference.
+    '''
+
+    def __init__(self, features, means, stds, centroids, spread, counts, sums, changed_since_fit=0,
+                 spreads=None):
+        self.features = list(features)
+        self.means = np.asarray(means, dtype=np.float64)
+        self.stds = np.asarray(stds, dtype=np.float64)
+        self.centroids = np.asarray(centroids, dtype=np.float64)
+        # fit-time mean squared distance of a county to its centroid, overall and per cluster
+        self.spread = float(spread)
+        self.spreads = None if spreads is None else np.asarray(spreads, dtype=np.float64)
+        # members and raw feature sums per cluster, kept up to date by update()
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.sums = np.asarray(sums, dtype=np.float64)
+        self.changed_since_fit = changed_since_fit
+        self.assignments = None
+
+    @classmethod
+    def fit(cls, frame, k, **params):
+        raw = prepare_features(frame)
+        x, means, stds = standardize(raw)
+        result = cached_fit(x, k, **params)
+        _, distances = assign(x, result.centroids)
+        counts = np.bincount(result.labels, minlength=k)
+        sums = np.zeros((k, raw.shape[1]))
+        np.add.at(sums, result.labels, raw)
+        spreads = np.bincount(result.labels, weights=distances, minlength=k) / np.maximum(counts, 1)
+        model = cls(FEATURES, means, stds, result.centroids, distances.mean(), counts, sums, spreads=spreads)
+        model.assignments = _assignments(frame, feature_matrix(frame), result.labels, distances)
+        return model
+
+    def transform(self, raw):
+        return (raw - self.means) / self.stds
+
+    def score(self, frame):
+        '''Nearest centroid and squared distance for each row of a county table.'''
+        return assign(self.transform(self._raw_features(frame)), self.centroids)
+
+    def _raw_features(self, frame):
+        # missing values are filled with the fit-time means, i.e. 0 once standardized
+        return prepare_features(frame, fill=self.means)
+
+    def _filled(self, features):
+        return np.where(np.isnan(features), self.means, features)
+
+    def update(self, frame):
+        '''Score counties that are new or whose features changed, and drop removed ones.
+
+        Returns which counties were scored, how many changed cluster and
+        whether drift is large enough that a full refit is advisable.
+        '''
+        old = self.assignments.set_index('FIPS')
+        # compared before filling, so a missing value matches the missing value stored for it
+        features = feature_matrix(frame)
+        raw = self._filled(features)
+        fips = frame['FIPS'].to_numpy()
+        known = old.reindex(fips)
+        previous = known[self.features].to_numpy(dtype=np.float64)
+        changed = ~np.isclose(features, previous, rtol=1e-9, atol=0, equal_nan=True).all(axis=1)
+        changed |= known['Cluster'].isna().to_numpy()
+        removed = old.index.difference(pd.Index(fips))
+
+        # take the old contribution of changed and removed counties out of the aggregates
+        leaving = pd.concat([known[changed & known['Cluster'].notna().to_numpy()], old.loc[removed]])
+        self._add(leaving['Cluster'].to_numpy(dtype=np.int64),
+                  self._filled(leaving[self.features].to_numpy(dtype=np.float64)), -1)
+
+        labels, distances = assign(self.transform(raw[changed]), self.centroids)
+        self._add(labels, raw[changed], 1)
+        before = known['Cluster'].to_numpy()[changed]
+        moved = int(((before != labels) & ~np.isnan(before)).sum())
+
+        assignments = _assignments(frame, features, known['Cluster'].to_numpy(), known['Distance'].to_numpy())
+        assignments.loc[changed, 'Cluster'] = labels
+        assignments.loc[changed, 'Distance'] = distances
+        assignments['Cluster'] = assignments['Cluster'].astype(np.int64)
+        self.assignments = assignments
+        self.changed_since_fit += int(changed.sum()) + len(removed)
+
+        drift = self.drift(labels, distances)
+        needs_refit = (drift['distance'] > DISTANCE_DRIFT or drift['centroid'] > CENTROID_DRIFT
+                       or drift['changed_share'] > CHANGED_SHARE)
+        return UpdateResult(fips[changed], moved, list(removed), needs_refit, drift)
+
+    def _add(self, labels, raw, sign):
+        if len(labels):
+            np.add.at(self.counts, labels, sign)
+            np.add.at(self.sums, labels, sign * raw)
+
+    def drift(self, labels=None, distances=None):
+        '''Drift measures compared against DISTANCE_DRIFT, CENTROID_DRIFT and CHANGED_SHARE.
+
+        The distance drift is the largest ratio, over clusters that got at
+        least MIN_SCORED of the scored counties, of their mean squared
+        distance to the centroid to the cluster's fit-time spread.
+        '''
+        spread = max(self.spread, 1e-12)
+        distance = 0.0
+        if labels is not None and len(labels):
+            k = len(self.centroids)
+            scored = np.bincount(labels, minlength=k)
+            judged = scored >= MIN_SCORED
+            if judged.any():
+                mean = np.bincount(labels, weights=distances, minlength=k)[judged] / scored[judged]
+                distance = float((mean / np.maximum(self.spreads[judged], 1e-12)).max())
+        filled = self.counts > 0
+        current = self.transform(self.sums[filled] / self.counts[filled, None])
+        shift = np.sqrt(((current - self.centroids[filled]) ** 2).sum(axis=1) / spread)
+        return {'distance': distance,
+                'centroid': float(shift.max()) if len(shift) else 0.0,
+                'changed_share': self.changed_since_fit / max(int(self.counts.sum()), 1)}
+
+    def summary(self):
+        '''Per-cluster means and member states from the running aggregates, like cluster_stats.csv.'''
+        columns = ['Political party (county)'] + NUMERIC_FEATURES
+        idx = [self.features.index(c) for c in columns]
+        means = self.sums[:, idx] / np.maximum(self.counts, 1)[:, None]
+        summary = pd.DataFrame(means, columns=columns).rename(columns=STATS_COLUMNS)
+        summary.insert(0, 'Cluster', np.arange(len(self.counts)))
+        states = (self.assignments['State abbreviation'].astype(str)
+                  .groupby(self.assignments['Cluster']).unique().str.join(', '))
+        summary['State'] = states.reindex(summary['Cluster']).to_numpy()
+        return summary
+
+    def save(self, path=MODEL_PATH):
+        params = {'features': self.features, 'means': self.means.tolist(), 'stds': self.stds.tolist(),
+                  'centroids': self.centroids.tolist(), 'spread': self.spread,
+                  'counts': self.counts.tolist(), 'sums': self.sums.tolist(),
+                  'changed_since_fit': self.changed_since_fit, 'spreads': self.spreads.tolist()}
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = temp_path(path)
+        with open(tmp, 'w') as outfile:
+            json.dump(params, outfile)
+        os.replace(tmp, path)
+        save_frame(self.assignments, ASSIGNMENTS)
+
+    @classmethod
+    def load(cls, path=MODEL_PATH):
+        '''The saved model, or None if there is none.'''
+        assignments = load_frame(ASSIGNMENTS)
+        if not os.path.exists(path) or assignments is None:
+            return None
+        with open(path, 'r') as infile:
+            model = cls(**json.load(infile))
+        model.assignments = assignments
+        return model
+
+
+def _assignments(frame, features, labels, distances):
+    assignments = pd.DataFrame(features, columns=FEATURES)
+    assignments.insert(0, 'FIPS', frame['FIPS'].to_numpy())
+    assignments['State abbreviation'] = frame['State abbreviation'].astype(str).to_numpy()
+    assignments['Cluster'] = labels
+    assignments['Distance'] = distances
+    return assignments
+
+
+def load_or_fit(frame, k, **params):
+    '''Bring the saved model up to date with frame, refitting only when needed.
+
+    Returns the model and whether it was refitted.
+    '''
+    model = ClusterModel.load()
+    # models saved before the per-cluster spreads were kept are refitted once
+    if (model is not None and len(model.centroids) == k and model.features == FEATURES
+            and model.spreads is not None):
+        result = model.update(frame)
+        if not result.needs_refit:
+            if len(result.scored) or result.removed:
+                model.save()
+            count_cache('cluster_model', hit=True)
+            return model, False
+    count_cache('cluster_model', hit=False)
+    model = ClusterModel.fit(frame, k, **params)
+    model.save()
+    return model, True
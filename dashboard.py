@@ -1,46 +1,206 @@
 #import and load packages
+import time
+started = time.perf_counter()
+
+import json
+import os
 import pandas as pd
 import streamlit as st
-from plotnine import ggplot, aes, geom_bar, scale_y_continuous, geom_text, coord_flip, theme, element_text, labs, scale_fill_manual, theme_minimal, geom_point, geom_line, position_stack, element_rect
-import matplotlib.pyplot as plt
-import geopandas as gpd
-import plotly.express as px
-import matplotlib.patches as mpatches
-from plotly.subplots import make_subplots
-import seaborn as sns
-import json
+import instrumentation
+from instrumentation import span
+from registry import DatasetRegistry, cached_resource, first_paint, report_first_paint
+
+instrumentation.start_rerun()
+
+# the cached tables are shared by every session and pages get shallow copies of
+# them, so copy-on-write must be on for writes to stay in the copy (always on
+# from pandas 3; streamlit imports pandas anyway)
+if int(pd.__version__.split('.')[0]) < 3:
+    pd.set_option('mode.copy_on_write', True)
+
+# the plotting, geo and data libraries are imported where they are first used,
+# so the text-only pages start without them
+
+FINAL_DATA = 'Input files/final_data.csv'
+COUNTIES = 'Input files/counties.json'
+# tract polygons and their id column for the tract level map
+TRACTS = ('Input files/map.gpkg', 'GEOID')
+
+# datasets each page uses, loaded on first access
+datasets = DatasetRegistry({
+    'Introduction': [],
+    'Datasets': ['final_data', 'final_data_version', 'final_data_summaries', 'charger_snap', 'sum_stats',
+                 'county_geometry', 'tract_tiles', 'tract_chargers'],
+    'Clustering intro': [],
+    'Analysis and results': ['final_data', 'final_data_version', 'county_geometry'],
+    'Conclusion': ['final_data', 'final_data_version'],
+    'References': [],
+})
 
 #import the data
-@st.cache_data
+# tables are cached as resources: every session reads the same compact, read-only
+# copy instead of unpickling its own (see shared.py)
+@cached_resource
 def load_data(filename):
-    return pd.read_csv(filename)
-df = load_data('Input files/final_data.csv')
-charger_snap = load_data('Input files/charger_snap.csv')
-sum_stats = load_data('Input files/sum_stats.csv')
-clustering = load_data('Input files/clustering_results.csv')
-clust_stats = load_data('Input files/cluster_stats.csv')
-
-@st.cache_data
+    from shared import compact, share
+    return share(filename, compact(pd.read_csv(filename)))
+
+# the county level tables come from the typed columnar store (FIPS already padded,
+# floats already float32), so they stay memory mapped;
+# the version argument makes the cache pick up a rebuilt store
+@cached_resource(max_entries=2)
+def load_stored_data(filename, version):
+    from datastore import load_table
+    from shared import share
+    return share(filename, load_table(filename))
+
+@datasets.register('final_data_version')
+def final_data_version():
+    from datastore import table_version
+    return table_version(FINAL_DATA)
+
+@datasets.register('final_data')
+def final_data():
+    return load_stored_data(FINAL_DATA, final_data_version())
+
+# box plot / histogram inputs for every numeric column, computed once per data version
+@cached_resource(max_entries=2)
+def load_summaries(_data, version):
+    from summaries import summarize
+    return summarize(_data)
+
+@datasets.register('final_data_summaries')
+def final_data_summaries():
+    return load_summaries(final_data(), final_data_version())
+
+# per-state network snapshot written by ingest.py from the raw AFDC export,
+# falling back to the hand-made table until an export has been ingested
+@cached_resource
+def load_charger_snapshot(filename):
+    from datastore import load_frame
+    from shared import share
+    snapshot = load_frame('charger_snap')
+    if snapshot is None:
+        snapshot = pd.read_csv(filename, encoding='utf-8-sig', thousands=' ').dropna(how='all')
+        snapshot = snapshot.astype({column: 'int64' for column in snapshot.columns[1:]})
+    return share('charger_snap', snapshot)
+
+datasets.register('charger_snap')(lambda: load_charger_snapshot('Input files/charger_snap.csv'))
+datasets.register('sum_stats')(lambda: load_data('Input files/sum_stats.csv'))
+
+# k-means on final_data.csv, cached per data version and k (see kmeans.py)
+N_CLUSTERS = 7
+SSE_RANGE = tuple(range(1, 17))
+
+# the saved model only scores counties whose features changed, and is refitted on drift
+@cached_resource(max_entries=2)
+def run_clustering(_data, version, k):
+    from cluster_model import load_or_fit
+    from kmeans import results_table
+    model, _ = load_or_fit(_data, k)
+    return results_table(_data, model.assignments['Cluster'].to_numpy()), model.summary()
+
+@cached_resource(max_entries=2)
+def run_sse_sweep(_data, version, ks):
+    from kmeans import cached_sse_sweep, prepare_features, standardize
+    x, _, _ = standardize(prepare_features(_data))
+    return cached_sse_sweep(x, ks)
+
+# county neighbour matrices for the hot spot map, built once and stored (see spatial_stats.py)
+NEIGHBOURS = {
+    'Shared border or corner (queen)': 'queen',
+    'Shared border (rook)': 'rook',
+    '8 nearest counties': 'knn',
+}
+
+@cached_resource
+def load_county_weights(kind):
+    from spatial_stats import load_weights
+    return load_weights(COUNTIES, 'id', kind)
+
+# global Moran's I and the LISA class of every county, per data version, variable and neighbours
+@cached_resource(max_entries=16)
+def run_hot_spots(_data, version, column, kind):
+    from spatial_stats import lisa, moran
+    counties = _data.dropna(subset=[column])
+    weights = load_county_weights(kind).subset(counties['FIPS'].tolist())
+    values = counties[column].to_numpy(dtype='float64')
+    local = lisa(values, weights)
+    hot_spots = counties[['FIPS', 'County', 'State']].assign(**{'Spatial cluster': local.label})
+    return moran(values, weights), hot_spots
+
+# only read while building the packed county geometry, so not cached itself
 def load_json_data(filename):
     with open(filename, 'r') as infile:
         data = json.load(infile)
     return data
 
-counties = load_json_data('Input files/counties.json')
+# simplified county shapes (built once per process) instead of the full 3 MB file per map
+@cached_resource
+def load_county_geometry(filename):
+    from geometry import CountyGeometry
+    from shared import share
+    return share('county_geometry', CountyGeometry(load_json_data(filename)))
+
+datasets.register('county_geometry')(lambda: load_county_geometry(COUNTIES))
+geometry_version = os.path.getmtime(COUNTIES)
+
+# finished figures are shared by all sessions and only rebuilt when their inputs change
+@cached_resource
+def get_figure_cache():
+    from figures import FigureCache
+    # figures are kept serialized (~1 MB per national map), so this holds the
+    # national and state maps of every variable and colour mode
+    return FigureCache(maxbytes=32 * 2**20)
+
+# st.plotly_chart turns a figure back into a dict and serializes it again on every
+# rerun, which takes about as long as building a national map; the cached spec is
+# handed to the chart element as it is instead
+def plotly_spec_chart(spec):
+    from streamlit.proto.PlotlyChart_pb2 import PlotlyChart
+    proto = PlotlyChart()
+    proto.theme = 'streamlit'
+    if 'figure' in PlotlyChart.DESCRIPTOR.fields_by_name:
+        # streamlit < 1.35 (the pinned 1.28)
+        proto.use_container_width = True
+        proto.figure.spec = spec
+        proto.figure.config = json.dumps({'showLink': False, 'linkText': False})
+        return st._main._enqueue('plotly_chart', proto)
+    from streamlit.elements.lib.layout_utils import LayoutConfig
+    proto.spec = spec
+    proto.config = '{}'
+    # plotly's default height, none of the figures set their own
+    return st._main._enqueue('plotly_chart', proto, layout_config=LayoutConfig(width='stretch', height=450))
+
+# tract polygons cut into tiles once (see tiles.py), None if the file has no tract ids
+@cached_resource
+def load_tract_tiles(source, id_field):
+    from tiles import has_field, load_tileset
+    from shared import share
+    if not has_field(source, id_field):
+        return None
+    return share('tract_tiles', load_tileset(source, id_field))
+
+datasets.register('tract_tiles')(lambda: load_tract_tiles(*TRACTS))
+
+# charger totals per tract, written by `python ingest.py <export> <tract polygons> GEOID`
+@cached_resource
+def load_tract_chargers():
+    from datastore import load_frame
+    return load_frame('tract_chargers')
+
+datasets.register('tract_chargers')(load_tract_chargers)
 
 # Note: the data is already preprocessed which is not included in this file (will be included in the final project submission)
 
 
-@st.cache_data
+@cached_resource
 def load_geodata(filename):
-    return gpd.read_file(filename)
-
-map = load_geodata('Input files/map.gpkg')
+    import geopandas as gpd
+    from shared import compact, share
+    return share(filename, compact(gpd.read_file(filename)))
 
-
-## Data preprocessing
-df['FIPS'] = df['FIPS'].astype(int).astype(str).str.zfill(5)
-clustering['FIPS'] = clustering['FIPS'].astype(int).astype(str).str.zfill(5)
+datasets.register('map')(lambda: load_geodata('Input files/map.gpkg'))
 
 
 ########################
@@ -55,6 +215,9 @@ option = st.sidebar.radio(
 st.sidebar.title("About")
 st.sidebar.info('This is a tutorial and demonstration on how to use publicly available data and unsupervised machine learning to analyze the EV network in the U.S. You can find all the corresponding code in this [GitHub](https://github.com/FanniVarhelyi/EV_charger_network_analysis.git) repo.\n\nDeveloped by Fanni Varhelyi')
 
+instrumentation.set_page(option)
+data = datasets.for_page(option)
+
 
 
 ########################################################################
@@ -83,7 +246,9 @@ elif option == 'Datasets':
 
     st.markdown('The primary data source for this research is the location of electric vehicle charging stations in the United States, which is available from the U.S. Department of Energy. This dataset contains the location of 58 857 charging stations and contains 71 further attributes. Of these attributes, the most important ones for this project will be location. Here\'s a summary look on the state level of the available total charging stations:')
 
-    st.table(charger_snap.iloc[:9,:])
+    charger_snap = data['charger_snap']
+    with span('table'):
+        st.table(charger_snap.iloc[:9,:])
 
     
 
@@ -128,14 +293,23 @@ elif option == 'Datasets':
 
     st.markdown('Once we have the number of chargers per census tract, we can easily merge this with any census variables we would like to include in our analysis. In this case, I selected total population, cars per household, poverty, and racial & ethnic attributes. When working with data like this, it\'s often useful to check the summary statistics for the relevant variables:')
 
-    st.table(sum_stats.iloc[:4,:5])
+    sum_stats = data['sum_stats']
+    with span('table'):
+        st.table(sum_stats.iloc[:4,:5])
     
     st.markdown('Unfortunately, when looking at our third dataset, we can see that information is not available on a census tract level. This is understadable: tracts are smaller than voter districts. Thus, we will need to aggregate again to have the same unit of analysis for all of our data. In this case, this will be a county level. Once we\'ve done this, and selected the relevant variables, we have our data ready for analysis!')
 
-    st.table(df.head(5))
+    df = data['final_data']
+    df_version = data['final_data_version']
+    with span('table'):
+        st.table(df.head(5))
 
     st.markdown('Another interesting way to look at our data and understand it\'s attributes is using visualizations. The next graph showcases the distribution of a given variable, while the following map of the United States shows the county-level value of a selected variable.')
 
+    from figures import color_mode, county_choropleth, distribution_figure
+    figure_cache = get_figure_cache()
+    county_geometry = data['county_geometry']
+
     ####ADD BOXPLOT
     variables = [
        '% of households with 2 or more cars',
@@ -147,11 +321,11 @@ elif option == 'Datasets':
        '% of white population']
     choice = st.selectbox('Variable', variables)
     
-    fig2 = plt.figure(figsize=(8, 6))
-    sns.boxplot(x=df[choice])
-    plt.title('Exploratory data analysis')
-    plt.xlabel(f'Variable: {choice}')
-    st.pyplot(fig2)
+    summary = data['final_data_summaries'][choice]
+    box_key = (df_version, 'distribution', choice)
+    fig = figure_cache.get(box_key, lambda: distribution_figure(summary, choice))
+    with span('plotly_chart'):
+        plotly_spec_chart(fig)
 
 
     #####ADD MAP
@@ -165,24 +339,10 @@ elif option == 'Datasets':
        '% of white population']
     choice2 = st.selectbox('Variable ', variables)
 
-    if choice2 == 'Political party (county)':
-    # Define the discrete color map for political parties
-        color_map = {'REPUBLICAN': 'red', 'DEMOCRAT': 'blue'}
-
-        fig = px.choropleth(df, geojson=counties, locations='FIPS', color=choice2,
-                            color_discrete_map=color_map,
-                            scope="usa",
-                            labels={choice2: 'Political Party'})
-    else:
-        # Use a continuous color scale
-        fig = px.choropleth(df, geojson=counties, locations='FIPS', color=choice2,
-                            color_continuous_scale="Viridis",
-                            scope="usa",
-                            labels={choice2: choice2})
-
-    fig.update_layout(margin={"r":0,"t":0,"l":0,"b":0})
-    #fig.show()
-    st.plotly_chart(fig, use_container_width=True)
+    map_key = (df_version, geometry_version, 'national', choice2, color_mode(choice2))
+    fig = figure_cache.get(map_key, lambda: county_choropleth(df, county_geometry.national(), choice2))
+    with span('plotly_chart'):
+        plotly_spec_chart(fig)
 
     st.markdown('Looking at counties on the country level, however, can make it difficult to understand local characteristics, so we can also zoom in on a given state and then look at our variables. Exploratory data analysis and visualizations such as these can help us better understand the data, which in turn will influence some of our design choices later on for the analysis.')
 
@@ -190,24 +350,48 @@ elif option == 'Datasets':
     choice3 = st.selectbox('Variable:', variables)
     choice4 = st.selectbox('State', df.State.unique().tolist())
 
-    filtered = df[df['State'] == choice4]
-    if choice3 == 'Political party (county)':
-        color_map = {'REPUBLICAN': 'red', 'DEMOCRAT': 'blue'}
-        fig = px.choropleth(filtered, geojson=counties, locations='FIPS', color=choice3,
-                                color_discrete_map=color_map,
-                                scope="usa",
-                                labels={choice3}
-                                )
-        fig.update_geos(fitbounds="locations", visible=False)
+    state_key = (df_version, geometry_version, 'state', choice4, choice3, color_mode(choice3))
+
+    def build_state_map():
+        with span('state_filter', state=choice4):
+            filtered = df[df['State'] == choice4]
+        # only ship the counties of the selected state
+        state_counties = county_geometry.state(filtered['FIPS'].iloc[0][:2])
+        return county_choropleth(filtered, state_counties, choice3, fit_bounds=True)
+
+    fig = figure_cache.get(state_key, build_state_map)
+    with span('plotly_chart'):
+        plotly_spec_chart(fig)
+
+    ##ADD MAP ON TRACT LEVEL
+    st.markdown('County values can still hide large differences within a county, so the last map goes down to census tracts. Pick an area and a zoom level: zoomed in, the map loads the tracts around that view, while zoomed out the tracts are summed into hexagons.')
+    tract_tiles = data['tract_tiles']
+    if tract_tiles is None:
+        st.info(f'The tract level map needs tract polygons with a {TRACTS[1]} column in {TRACTS[0]}.')
     else:
-        fig = px.choropleth(filtered, geojson=counties, locations='FIPS', color=choice3,
-                                color_continuous_scale="Viridis",
-                                scope="usa",
-                                labels={choice3}
-                                )
-        fig.update_geos(fitbounds="locations", visible=False)
-    fig.update_layout(margin={"r":0,"t":0,"l":0,"b":0})
-    st.plotly_chart(fig, use_container_width=True)
+        from figures import tract_deck
+        from tiles import fit_view
+        tract_variables = {'Number of Level 2 chargers': 'EV Level2 EVSE Num',
+                           'Number of Level 3 chargers': 'EV DC Fast Count',
+                           'Number of Level 1 chargers': 'EV Level1 EVSE Num'}
+        choice6 = st.selectbox('Tract variable', list(tract_variables))
+        state_fips = df.groupby('State', observed=True)['FIPS'].first().str[:2]
+        choice7 = st.selectbox('Area', ['United States'] + state_fips.index.tolist())
+        bounds = (-125.0, 24.0, -66.0, 50.0) if choice7 == 'United States' \
+            else county_geometry.state_bounds(state_fips[choice7])
+        fitted = fit_view(bounds, 700, 500, min_zoom=3.0, max_zoom=12.0)
+        zoom = st.slider('Zoom', 3.0, 12.0, round(fitted.zoom * 2) / 2, 0.5)
+        view = fitted._replace(zoom=zoom)
+
+        tract_chargers = data['tract_chargers']
+        if tract_chargers is None:
+            st.caption('No charger totals per tract yet: run ingest.py with the tract polygons to add them.')
+            values = pd.Series(dtype='float64')
+        else:
+            values = tract_chargers.set_index(TRACTS[1])[tract_variables[choice6]]
+        deck = tract_deck(tract_tiles, view, values, choice6)
+        with span('pydeck_chart'):
+            st.pydeck_chart(deck, use_container_width=True)
 
 
     st.caption('*Data sources: [Census Bureau](https://www.census.gov/programs-surveys/acs), [Department of Energy](https://afdc.energy.gov/fuels/electricity_locations.html#/find/nearest?fuel=ELEC), [MIT Election Data and Science Lab](https://electionlab.mit.edu/data).*')
@@ -244,7 +428,7 @@ elif option == 'Analysis and results':
     st.image('Input images/results.jpg')
     st.subheader(":green[Analysis]")
 
-    st.markdown('For our analysis, we will leverage the popular machine learning library scicit learn, or sklearn. Sklearn can help both preprocess our data and implement the clustering model.\n\nPreprocessing is important when clustering: it ensures we account for differences in scale. In our case, many of our variables are already on the same scale: we`re using percentages for motiple variables. Regardless, it makes sense to standardize all variables.\n\nBefore this step, we also need to drop all columns that contain information that is unnecessary for the clustering itself. These are usually columns containing identifying information, such as the county name or county fips number. I also decided to not inlcude state as a variable. Thus, the final variable list is as follows:')
+    st.markdown('For our analysis, the app runs the clustering itself, with a small NumPy implementation (kmeans.py) of what the popular machine learning library scikit-learn, or sklearn, offers for preprocessing the data and for the clustering model. This way the results below always reflect the current data.\n\nPreprocessing is important when clustering: it ensures we account for differences in scale. In our case, many of our variables are already on the same scale: we`re using percentages for motiple variables. Regardless, it makes sense to standardize all variables.\n\nBefore this step, we also need to drop all columns that contain information that is unnecessary for the clustering itself. These are usually columns containing identifying information, such as the county name or county fips number. I also decided to not inlcude state as a variable. Thus, the final variable list is as follows:')
 
     #check if works!!!
     st.markdown('- Vehicle ownership: percentage of households with 2 or more cars\n- Number of Level 3 chargers\n- Number of Level 2 chargers\n- Number of Level 1 chargers\n- Percentage of white population\n- Percentage of Non-Hispanic Black population\n- Percentage of Hispanic population\n- Percentage of the population below the poverty line\n- County political affiliation\n- state political affiliation')
@@ -252,46 +436,63 @@ elif option == 'Analysis and results':
     st.markdown('Once we have selected only these variables, we can then normalize our data:')
 
     code3 = '''
-    from sklearn.preprocessing import StandardScaler
-    from sklearn.cluster import KMeans
+    from kmeans import prepare_features, standardize
 
-    x = ev_chargers.drop(columns=['county_fips', 'state_y',
-                              'county_name', 'state_po',
-                              'state_party'])
-    x['party'] =  x['party'].replace({'REPUBLICAN': 0, 'DEMOCRAT': 1})
+    # the variables above, with the county and state party coded as 0 (Republican) / 1 (Democrat)
+    x = prepare_features(final_data)
 
-    x = pd.DataFrame(StandardScaler().fit_transform(x))
+    # like sklearn's StandardScaler: every column gets mean 0 and standard deviation 1
+    x, means, stds = standardize(x)
     '''
 
     st.code(code3, language = 'python')
 
     st.markdown('After preprocessing the data, we can finally decide what the optimal number of clusters would be. To do so, we would like to find a number of clusters that minimizes the overall error in our clusters. In other words, we\'re looking for clusters that are well-formed, don\'t overlap, and make sense. Let\'s take a look at this overall error (the sum of squared errors or SSE to be precise) for a k between 1 and 16.')
 
-    st.image('Input images/sse.jpg')
+    from figures import color_mode, county_choropleth, elbow_figure
+    figure_cache = get_figure_cache()
+    df = data['final_data']
+    df_version = data['final_data_version']
+
+    sse = run_sse_sweep(df, df_version, SSE_RANGE)
+    fig = figure_cache.get((df_version, 'elbow', SSE_RANGE), lambda: elbow_figure(SSE_RANGE, sse))
+    with span('plotly_chart'):
+        plotly_spec_chart(fig)
 
-    st.markdown('An optimal number would probably be 7 clusters. Using this information, we can run the clustering algorithm with k = 7.')
+    from kmeans import elbow
+    bend = elbow(SSE_RANGE, sse)
+    if bend == N_CLUSTERS:
+        st.markdown(f'An optimal number would probably be {N_CLUSTERS} clusters: that is where the curve bends most. Using this information, we can run the clustering algorithm with k = {N_CLUSTERS}.')
+    else:
+        st.markdown(f'The curve bends most at k = {bend}, but the error keeps falling gradually after that, so there is no single optimal number and picking k is a judgement call. In this tutorial we will run the clustering algorithm with k = {N_CLUSTERS}.')
 
     code4 = '''
-    km = KMeans(n_clusters=7, init='random', random_state=0)
-    km_clusters = km.fit_predict(x)
+    from kmeans import fit
+
+    # k-means++ starting points, best of 4 runs; clusters are numbered
+    # from the largest (0) to the smallest
+    result = fit(x, k=7, init='k-means++', n_init=4, seed=0)
+    clusters = result.labels
     '''
 
     st.code(code4, language = 'python')
 
     st.markdown('We can see a snapshot of the results below.')
 
-    st.table(clustering.sample(10))
+    clustering, clust_stats = run_clustering(df, df_version, N_CLUSTERS)
+
+    with span('table'):
+        st.table(clustering.sample(10))
 
     st.subheader(":green[Results]")
 
     st.markdown('To understand the results, we could, for example, look at the summary statistics again, but by clusters.')
 
-    st.table(clust_stats.iloc[:, :-1])
+    with span('table'):
+        st.table(clust_stats.iloc[:, :-1])
 
     st.markdown('Alternatively, we could also take a look at a map again to visualize the clusters.')
 
-    #st.image('Input images/plot_clusters.jpg')
-
     variables = ['Cluster',
                  'Political party (county)',
        '% of households with 2 or more cars',
@@ -303,42 +504,27 @@ elif option == 'Analysis and results':
        '% of white population']
     choice5 = st.selectbox('Variable or cluster:', variables)
 
-    if choice5 == 'Political party (county)':
-    # Define the discrete color map for political parties
-        color_map = {'REPUBLICAN': 'red', 'DEMOCRAT': 'blue'}
-
-        fig = px.choropleth(clustering, geojson=counties, locations='FIPS', color=choice5,
-                            color_discrete_map=color_map,
-                            scope="usa",
-                            labels={choice5: 'Political Party'})
-    elif choice5 == 'Cluster':
-        clustering['Cluster'] = clustering['Cluster'].astype(str)
-        # Define a discrete color map for clusters
-        # You can customize this list of colors as needed
-        cluster_colors = [
-        '#6a0dad',  # Dark purple
-        '#9b30ff',  # Light purple
-        '#008000',  # Office Green
-        '#00ff00',  # Lime Green
-        '#0000ff',  # Blue
-        '#00ced1',  # Dark Turquoise
-        '#7fffd4'   # Aquamarine
-        ]
-
-        fig = px.choropleth(clustering, geojson=counties, locations='FIPS', color=choice5,
-                        color_discrete_sequence=cluster_colors,
-                        scope="usa",
-                        labels={choice5: 'Clusters'})
-    else:
-        # Use a continuous color scale
-        fig = px.choropleth(clustering, geojson=counties, locations='FIPS', color=choice5,
-                            color_continuous_scale="Viridis",
-                            scope="usa",
-                            labels={choice5: choice5})
-
-    fig.update_layout(margin={"r":0,"t":0,"l":0,"b":0})
-    #fig.show()
-    st.plotly_chart(fig, use_container_width=True)
+    cluster_key = (df_version, N_CLUSTERS, geometry_version, 'clusters', choice5, color_mode(choice5))
+    county_geometry = data['county_geometry']
+    fig = figure_cache.get(cluster_key, lambda: county_choropleth(clustering, county_geometry.national(), choice5))
+    with span('plotly_chart'):
+        plotly_spec_chart(fig)
+
+    st.subheader(":green[Spatial hot spots]")
+
+    st.markdown('K-means treats every county on its own and ignores where it is. To see whether similar values sit next to each other, we can use spatial autocorrelation. The global Moran\'s I tells us whether a variable is clustered in space overall (values close to 0 mean no spatial pattern), while the local version (LISA) finds the counties that, together with their neighbours, form significant hot spots (high values surrounded by high values) or cold spots (low values surrounded by low values). Significance comes from 999 random permutations of the values.')
+
+    choice8 = st.selectbox('Variable for hot spots:', variables[2:])
+    choice9 = st.selectbox('Neighbours:', list(NEIGHBOURS))
+
+    global_moran, hot_spots = run_hot_spots(df, df_version, choice8, NEIGHBOURS[choice9])
+    st.metric('Global Moran\'s I', f'{global_moran.I:.3f}')
+    st.caption(f'Pseudo p-value: {global_moran.p_value:.3f}, z-score: {global_moran.z_score:.1f}')
+
+    lisa_key = (df_version, geometry_version, 'lisa', choice8, NEIGHBOURS[choice9])
+    fig = figure_cache.get(lisa_key, lambda: county_choropleth(hot_spots, county_geometry.national(), 'Spatial cluster'))
+    with span('plotly_chart'):
+        plotly_spec_chart(fig)
     
 ########################################################################
 ## PAGE 5: CONCLUSIONS
@@ -346,7 +532,65 @@ elif option == 'Analysis and results':
 elif option == 'Conclusion':
     st.image('Input images/conclusion.jpg')
 
-    st.markdown('In this tutorial, we learned how to merge publicly available datasets with different levels of aggregation, and how to use clustering to start to understand some patterns in EV charger placements in the United States.\n\nOur results indicate California counties are outliers even compared to other rich, Democrat-leaning counties. This can be alarming given that California is just a small subset of the country and EV adoption in the rest of the country could have lead to, for example, big cities in other states being similar to big cities in California.\n\nAnother key finding is that county political affiliation matters: most counties clustered together (for clusters 1, 2, 3, 5, 7) have very similar or the same political affiliations.\n\nThese preliminary results can help guide further research. For example, we could investigate if there are other characteristics neglegted here that could be important. We could look at the different cluster attributes and think how these could influence policymaking. For example, it seems like Republican counties tend to be similar and might even have less charging stations. Federal policy could focus on incentives to increase adoption in these areas. We could also look at the results on poverty and race & ethnicity, and further try to understand where EV chargers lag behind (such as in cluster 4, with smaller number of charging stations and high poverty). We could zoom in on these counties and try to better understand what the issue is, and if state-level incentives could help increase the number of charging stations. We should probably also look at population density, overall population and roads in any given county to understand them better.')
+    # the findings are read from the clusters the app computed, so they follow the data
+    df = data['final_data']
+    clustering, clust_stats = run_clustering(df, data['final_data_version'], N_CLUSTERS)
+    stats = clust_stats.set_index('Cluster')
+    party = stats['Political party affiliation (county-level)']
+    level2 = stats['Number of Level 2 chargers']
+    poverty = stats['Percentage of the population below the poverty line']
+    sizes = clustering['Cluster'].value_counts()
+    all_level2 = clustering['Number of Level 2 chargers'].mean()
+    all_poverty = clustering['% of the population in poverty'].mean()
+
+    # clusters this small are outliers rather than groups, and a share of one county says little
+    min_group = 10
+    groups = sizes[sizes >= min_group].index.sort_values()
+    singles = sizes[sizes == 1].index.sort_values()
+
+    top = level2.idxmax()
+    top_states = clustering.loc[clustering['Cluster'] == top, 'State'].astype(str).value_counts()
+    if sizes[top] == 1:
+        top_finding = f'Our results indicate that the county with the most chargers is an outlier: it forms a cluster of its own (cluster {top}, in {top_states.index[0].title()}) with {level2[top]:.0f} Level 2 chargers, against {all_level2:.0f} per county across all counties.'
+    else:
+        size_text = 'a small cluster of their own' if sizes[top] <= 0.05 * len(clustering) else 'a cluster of their own'
+        top_finding = (f'Our results indicate that the counties with the most chargers form {size_text} (cluster {top}, {sizes[top]} counties) with {level2[top]:.0f} Level 2 chargers per county on average, against {all_level2:.0f} across all counties. '
+                       f'{top_states.iloc[0] / sizes[top]:.0%} of them are in {top_states.index[0].title()}.')
+        if top_states.iloc[0] / sizes[top] >= 0.5:
+            top_finding += f' This can be alarming given that {top_states.index[0].title()} is just a small subset of the country and EV adoption in the rest of the country could have lead to, for example, big cities in other states being similar to big cities in {top_states.index[0].title()}.'
+    others = [c for c in singles if c != top]
+    if others:
+        named = ', '.join(f'cluster {c} ({clustering.loc[clustering["Cluster"] == c, "County"].iloc[0].title()}, {clustering.loc[clustering["Cluster"] == c, "State"].iloc[0].title()})' for c in others)
+        top_finding += f' Some clusters hold a single county and are best read as outliers: {named}.'
+
+    # clusters of at least min_group counties where at least 90% of the counties lean the same way
+    uniform = [c for c in groups if party[c] <= 0.1 or party[c] >= 0.9]
+    if uniform:
+        lead = 'Another key finding is that county political affiliation matters' if 2 * len(uniform) > len(groups) \
+            else 'County political affiliation matters for part of the country'
+        party_finding = (f'{lead}: in {len(uniform)} of the {len(groups)} clusters with at least {min_group} counties (clusters {", ".join(str(c) for c in uniform)}, with {sizes[uniform].sum() / len(clustering):.0%} of all counties), at least 90% of the counties have the same political affiliation.')
+    else:
+        party_finding = f'County political affiliation is mixed within the clusters: none of the {len(groups)} clusters with at least {min_group} counties has 90% or more of its counties leaning the same way.'
+
+    research = 'These preliminary results can help guide further research. For example, we could investigate if there are other characteristics neglegted here that could be important. We could look at the different cluster attributes and think how these could influence policymaking.'
+    republican = [c for c in groups if party[c] <= 0.1]
+    if republican:
+        republican_level2 = (level2[republican] * sizes[republican]).sum() / sizes[republican].sum()
+        comparison = 'fewer' if republican_level2 < all_level2 else 'more'
+        research += f' For example, the mostly Republican clusters ({", ".join(str(c) for c in republican)}) have {republican_level2:.0f} Level 2 chargers per county on average, {comparison} than the {all_level2:.0f} overall.'
+        if comparison == 'fewer':
+            research += ' Federal policy could focus on incentives to increase adoption in these areas.'
+    # the poorest of the clusters with fewer chargers than the average county
+    lagging = [c for c in groups if level2[c] < all_level2 and poverty[c] > all_poverty]
+    if lagging:
+        poorest = poverty[lagging].idxmax()
+        research += f' We could also look at the results on poverty and race & ethnicity, and further try to understand where EV chargers lag behind (such as in cluster {poorest}, where {poverty[poorest]:.0%} of the population is below the poverty line on average against {all_poverty:.0%} overall, with only {level2[poorest]:.0f} Level 2 chargers per county). We could zoom in on these counties and try to better understand what the issue is, and if state-level incentives could help increase the number of charging stations.'
+    else:
+        research += ' We could also look at the results on poverty and race & ethnicity: none of the clusters combines above average poverty with fewer chargers than average, but the counties within a cluster still differ.'
+    research += ' We should probably also look at population density, overall population and roads in any given county to understand them better.'
+
+    st.markdown('In this tutorial, we learned how to merge publicly available datasets with different levels of aggregation, and how to use clustering to start to understand some patterns in EV charger placements in the United States.\n\n'
+                + top_finding + '\n\n' + party_finding + '\n\n' + research)
 
 ########################################################################
 ## PAGE 6: REFS
@@ -355,4 +599,17 @@ elif option == 'References':
     st.markdown('Bibliography:\n\nBarkenbus, J. N. (2020). Prospects for Electric Vehicles. Sustainability 12, no. 14: 5813.\n\nEl Rai, M.C., Hadi, S.A., Damis, H. A. and Gawanmeh, A. (2022). Prediction of Electric Vehicle Charging Stations Distribution Using Machine Learning. 2022 5th International Conference on Signal Processing and Information Security (ICSPIS), Dubai, United Arab Emirates, pp. 154-157\n\nLutsey, N. (2015). Global climate change mitigation potential from a transition to electric vehicles. International Council on Clean Transportation.\n\nThe White House. (2023). FACT SHEET: Biden-⁠Harris Administration Announces New Standards and Major Progress for a Made-in-America National Network of Electric Vehicle Chargers. The White House.\n\nTran, M., Banister, D., Bishop, J. et al. (2012) Realizing the electric-vehicle revolution. Nature Clim Change 2, 328–333')
     st.markdown('Data sources: [Census Bureau](https://www.census.gov/programs-surveys/acs), [Department of Energy](https://afdc.energy.gov/fuels/electricity_locations.html#/find/nearest?fuel=ELEC), [MIT Election Data and Science Lab](https://electionlab.mit.edu/data).')
 
-
+report_first_paint(option, started)
+instrumentation.finish_rerun()
+
+# hidden profiling panel, enabled with EV_DASHBOARD_PROFILE=1
+if instrumentation.PROFILE_PANEL:
+    with st.sidebar.expander('Profiling: last reruns'):
+        st.metric('Time to first paint', f"{first_paint[option]['seconds']:.2f} s",
+                  help='From script start until this page was drawn (cold: first rerun of the process)')
+        st.dataframe([{'page': page, **paint} for page, paint in first_paint.items()])
+        st.dataframe(instrumentation.stage_breakdown(instrumentation.recent_reruns()))
+        from shared import memory_report
+        memory = memory_report()
+        st.metric('Replica memory (RSS)', f"{memory['rss'] / 2**20:.0f} MB")
+        st.metric('Shared tables', f"{memory['shared_tables'] / 2**20:.1f} MB")
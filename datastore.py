@@ -0,0 +1,156 @@
+#columnar on-disk store for the input tables
+import os
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from instrumentation import count_cache, span
+
+
+STORE_DIR = 'Input files/store'
+
+# bump when the stored layout changes so old store files get rebuilt
+STORE_VERSION = '2'
+
+# fixed width identifier columns and their width
+ID_COLUMNS = {'FIPS': 5, 'GEOID': 11}
+
+CATEGORICAL_COLUMNS = ['State', 'County', 'State abbreviation',
+                       'Political party (county)', 'Political party (state)']
+
+# a float column is stored as float32 when no value changes by more than this
+FLOAT32_RTOL = 1e-6
+# string columns with at most this share of distinct values become categoricals
+CATEGORY_SHARE = 0.5
+
+
+def store_path(source):
+    name = os.path.splitext(os.path.basename(source))[0]
+    return os.path.join(STORE_DIR, name + '.arrow')
+
+
+def temp_path(path):
+    '''A name next to path that no other writer uses, to write to before os.replace.
+
+    Sessions and replicas can rebuild the same store file at the same time,
+    so a fixed temporary name would let one writer publish another's partial file.
+    '''
+    root, ext = os.path.splitext(path)
+    return f'{root}.{os.getpid()}-{uuid.uuid4().hex}.tmp{ext}'
+
+
+def is_fresh(source):
+    path = store_path(source)
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(source):
+        return False
+    metadata = feather.read_table(path, memory_map=True).schema.metadata or {}
+    return metadata.get(b'store_version') == STORE_VERSION.encode()
+
+
+def table_version(source):
+    '''Identifies the current contents of a stored table (changes on every ingest).'''
+    fresh = is_fresh(source)
+    count_cache('table_store', hit=fresh)
+    if not fresh:
+        ingest(source)
+    return os.path.getmtime(store_path(source))
+
+
+def compact(frame):
+    '''Downcast float columns to float32 where that keeps FLOAT32_RTOL precision
+    and turn repetitive string columns into categoricals.'''
+    columns = {}
+    for column in frame.columns:
+        values = frame[column]
+        if values.dtype == np.float64:
+            narrow = values.to_numpy().astype(np.float32)
+            if np.allclose(narrow, values.to_numpy(), rtol=FLOAT32_RTOL, atol=0, equal_nan=True):
+                columns[column] = narrow
+        elif (values.dtype == object or pd.api.types.is_string_dtype(values.dtype)) \
+                and not isinstance(values.dtype, pd.CategoricalDtype) \
+                and values.nunique() <= CATEGORY_SHARE * len(values):
+            columns[column] = values.astype('category')
+    return frame.assign(**columns) if columns else frame
+
+
+def _normalize(frame):
+    with span('fips_normalize'):
+        for column, width in ID_COLUMNS.items():
+            if column in frame:
+                frame[column] = frame[column].astype(int).astype(str).str.zfill(width)
+    for column in CATEGORICAL_COLUMNS:
+        if column in frame:
+            frame[column] = frame[column].astype('category')
+    # stored with the compact types, so the mapped file loads without a converting copy
+    return compact(frame)
+
+
+def _write(frame, path):
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                           b'store_version': STORE_VERSION.encode()})
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write next to the target and swap it in, so readers never see a partial file
+    tmp = temp_path(path)
+    feather.write_feather(table, tmp, compression='uncompressed')
+    os.replace(tmp, path)
+    return path
+
+
+def ingest(source):
+    '''Parse a CSV once and write it to the store as an uncompressed Arrow file.'''
+    frame = _normalize(pd.read_csv(source, dtype={column: str for column in ID_COLUMNS}))
+    return _write(frame, store_path(source))
+
+
+def save_frame(frame, name):
+    '''Write a derived table (no CSV source) to the store under the given name.'''
+    return _write(frame, os.path.join(STORE_DIR, name + '.arrow'))
+
+
+@contextmanager
+def frame_writer(name, schema):
+    '''Write a derived table in chunks, for tables too big to build in memory.
+
+    Yields a function that appends a DataFrame with the given Arrow schema;
+    the file replaces the stored table when the block ends without an error.
+    '''
+    path = os.path.join(STORE_DIR, name + '.arrow')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    schema = schema.with_metadata({b'store_version': STORE_VERSION.encode()})
+    tmp = temp_path(path)
+    try:
+        with pa.OSFile(tmp, 'wb') as sink, pa.ipc.new_file(sink, schema) as writer:
+            yield lambda frame: writer.write_table(pa.Table.from_pandas(frame, schema=schema,
+                                                                        preserve_index=False))
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def load_frame(name):
+    '''Load a derived table written by save_frame, or None if it was never written.'''
+    path = os.path.join(STORE_DIR, name + '.arrow')
+    if not os.path.exists(path):
+        return None
+    return feather.read_table(path, memory_map=True).to_pandas(split_blocks=True)
+
+
+def load_table(source):
+    '''Load a table from the store, (re)building it from the CSV when stale.
+
+    The Arrow file is memory mapped and already holds the compact types (see
+    compact()), so numeric columns are handed to pandas without copying and
+    no CSV parsing, FIPS fix-ups or downcasting happen on load.
+    '''
+    fresh = is_fresh(source)
+    count_cache('table_store', hit=fresh)
+    if not fresh:
+        ingest(source)
+    table = feather.read_table(store_path(source), memory_map=True)
+    return table.to_pandas(split_blocks=True)
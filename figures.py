@@ -0,0 +1,240 @@
+#figure builders and a figure cache shared by every session
+import threading
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+import plotly.express as px
+import plotly.graph_objects as go
+import pydeck as pdk
+from plotly.subplots import make_subplots
+
+from instrumentation import span
+
+
+PARTY_COLORS = {'REPUBLICAN': 'red', 'DEMOCRAT': 'blue'}
+
+CLUSTER_COLORS = [
+    '#6a0dad',  # Dark purple
+    '#9b30ff',  # Light purple
+    '#008000',  # Office Green
+    '#00ff00',  # Lime Green
+    '#0000ff',  # Blue
+    '#00ced1',  # Dark Turquoise
+    '#7fffd4'   # Aquamarine
+]
+
+# LISA classes of the hot spot map (see spatial_stats.py)
+LISA_COLORS = {
+    'Hot spot': '#d7191c',
+    'High-low outlier': '#fdae61',
+    'Low-high outlier': '#abd9e9',
+    'Cold spot': '#2c7bb6',
+    'Not significant': '#e0e0e0',
+}
+
+# viridis stops for the deck.gl maps, which take one RGB colour per row
+VIRIDIS = np.array([[68, 1, 84], [59, 82, 139], [33, 145, 140], [94, 201, 98], [253, 231, 37]])
+MISSING_COLOR = [200, 200, 200]
+
+
+# every live FigureCache, for process-wide statistics
+_caches = weakref.WeakSet()
+
+
+def figure_cache_stats():
+    '''Hit, miss and size counts summed over all figure caches of the process.'''
+    totals = {'size': 0, 'bytes': 0, 'hits': 0, 'misses': 0}
+    for cache in list(_caches):
+        for name, value in cache.stats().items():
+            totals[name] += value
+    return totals
+
+
+def figure_spec(figure):
+    # the plotly JSON the browser receives
+    return figure.to_json()
+
+
+class FigureCache:
+    '''LRU cache of serialized figures, bounded by their total size in bytes.
+
+    Keys should contain everything a figure depends on (table version,
+    selected column, colour mode, state, ...), so a figure is only rebuilt
+    when one of its inputs changes. Safe to share between sessions.
+
+    A figure is serialized once, when it is built, and only the spec (a
+    JSON string) is kept: a cache hit costs no plotly work at all, and an
+    entry takes its serialized size in memory instead of the 7-25 times
+    that a plotly figure holding its own copy of the geojson would.
+    '''
+
+    def __init__(self, maxbytes=32 * 2**20, serialize=figure_spec):
+        self.maxbytes = maxbytes
+        self.serialize = serialize
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        # key -> serialized spec
+        self._specs = OrderedDict()
+        self._lock = threading.Lock()
+        _caches.add(self)
+
+    def get(self, key, build):
+        '''The cached spec for key, or build() serialized and added to the cache.'''
+        with self._lock:
+            if key in self._specs:
+                self.hits += 1
+                self._specs.move_to_end(key)
+                return self._specs[key]
+            self.misses += 1
+        # build and serialize outside the lock so a slow figure does not block other sessions
+        spec = self.serialize(build())
+        with self._lock:
+            if key in self._specs:
+                self.nbytes -= len(self._specs[key])
+            self._specs[key] = spec
+            self._specs.move_to_end(key)
+            self.nbytes += len(spec)
+            # always keep the newest figure, even if it is larger than maxbytes
+            while self.nbytes > self.maxbytes and len(self._specs) > 1:
+                _, evicted = self._specs.popitem(last=False)
+                self.nbytes -= len(evicted)
+        return spec
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._specs), 'bytes': self.nbytes, 'hits': self.hits, 'misses': self.misses}
+
+
+def color_mode(column):
+    if column == 'Political party (county)':
+        return 'party'
+    if column == 'Cluster':
+        return 'cluster'
+    if column == 'Spatial cluster':
+        return 'lisa'
+    return 'continuous'
+
+
+def county_choropleth(data, geojson, column, fit_bounds=False):
+    with span('choropleth', column=column):
+        return _county_choropleth(data, geojson, column, fit_bounds)
+
+
+def _county_choropleth(data, geojson, column, fit_bounds):
+    mode = color_mode(column)
+    if mode == 'party':
+        fig = px.choropleth(data, geojson=geojson, locations='FIPS', color=column,
+                            color_discrete_map=PARTY_COLORS,
+                            scope="usa",
+                            labels={column: 'Political Party'})
+    elif mode == 'cluster':
+        data = data.assign(**{column: data[column].astype(str)})
+        fig = px.choropleth(data, geojson=geojson, locations='FIPS', color=column,
+                            color_discrete_sequence=CLUSTER_COLORS,
+                            scope="usa",
+                            labels={column: 'Clusters'})
+    elif mode == 'lisa':
+        fig = px.choropleth(data, geojson=geojson, locations='FIPS', color=column,
+                            color_discrete_map=LISA_COLORS,
+                            category_orders={column: list(LISA_COLORS)},
+                            scope="usa",
+                            labels={column: 'Spatial cluster'})
+    else:
+        # Use a continuous color scale
+        fig = px.choropleth(data, geojson=geojson, locations='FIPS', color=column,
+                            color_continuous_scale="Viridis",
+                            scope="usa",
+                            labels={column: column})
+    if mode != 'continuous':
+        _split_geojson(fig, geojson)
+    if fit_bounds:
+        fig.update_geos(fitbounds="locations", visible=False)
+    fig.update_layout(margin={"r":0,"t":0,"l":0,"b":0})
+    return fig
+
+
+def _split_geojson(fig, geojson):
+    # plotly express draws one trace per category and gives each the whole
+    # geojson; keep only that trace's counties so every shape is sent once
+    features = {feature['id']: feature for feature in geojson['features']}
+    for trace in fig.data:
+        trace.geojson = {'type': 'FeatureCollection',
+                         'features': [features[i] for i in trace.locations if i in features]}
+
+
+def _colors(values, upper):
+    # values -> viridis RGB rows, grey where there is no value
+    scaled = np.clip(np.nan_to_num(values / max(upper, 1e-12), nan=0.0), 0, 1) * (len(VIRIDIS) - 1)
+    stops = np.arange(len(VIRIDIS))
+    rgb = np.stack([np.interp(scaled, stops, VIRIDIS[:, c]) for c in range(3)], axis=1).astype(int)
+    rgb[np.isnan(values)] = MISSING_COLOR
+    return rgb.tolist()
+
+
+def tract_deck(tiles, view, values, label):
+    '''deck.gl map of values per polygon of a tiles.TileSet around a view.
+
+    Zoomed in, only the polygons of the tiles in view are sent; zoomed out
+    they are summed into hexagons on the server and sent as hexagon outlines.
+    '''
+    with span('tract_deck', zoom=view.zoom):
+        return _tract_deck(tiles, view, values, label)
+
+
+def _tract_deck(tiles, view, values, label):
+    polygons = tiles.polygons(view, values)
+    if polygons is not None:
+        upper = np.nanquantile(values.to_numpy(dtype=np.float64), 0.98) if len(values) else 1.0
+        polygons['color'] = _colors(polygons['value'].to_numpy(), upper)
+        layer = pdk.Layer('PolygonLayer', polygons, id='tracts', get_polygon='polygon', get_fill_color='color',
+                          get_line_color=[255, 255, 255], line_width_min_pixels=0.5,
+                          opacity=0.7, stroked=True, filled=True, pickable=True)
+        tooltip = {'text': f'{{id}}\n{label}: {{value}}'}
+    else:
+        hexagons = tiles.hexagons(view, values)
+        upper = np.quantile(hexagons['value'], 0.98) if len(hexagons) else 1.0
+        hexagons['color'] = _colors(hexagons['value'].to_numpy(), upper)
+        layer = pdk.Layer('PolygonLayer', hexagons, id='tract_hexagons', get_polygon='polygon',
+                          get_fill_color='color', stroked=False, filled=True, opacity=0.7, pickable=True)
+        tooltip = {'text': f'{label}: {{value}}\nareas: {{areas}}, without chargers: {{gaps}}'}
+    view_state = pdk.ViewState(longitude=view.longitude, latitude=view.latitude, zoom=view.zoom)
+    # repeated world copies, so areas across the antimeridian (the Aleutians) draw next to each other
+    map_view = pdk.View('MapView', controller=True, repeat=True)
+    return pdk.Deck(layers=[layer], views=[map_view], initial_view_state=view_state, map_style='light',
+                    tooltip=tooltip)
+
+
+def elbow_figure(ks, sse):
+    fig = px.line(x=list(ks), y=sse, markers=True,
+                  labels={'x': 'Number of clusters (k)', 'y': 'SSE'})
+    fig.update_layout(margin={"r":0,"t":0,"l":0,"b":0})
+    return fig
+
+
+def distribution_figure(summary, column):
+    '''Box plot and histogram drawn in the browser from a precomputed Summary.'''
+    with span('distribution_figure', column=column):
+        return _distribution_figure(summary, column)
+
+
+def _distribution_figure(summary, column):
+    fig = make_subplots(rows=2, cols=1, shared_xaxes=True, row_heights=[0.3, 0.7],
+                        vertical_spacing=0.05)
+    fig.add_trace(go.Box(q1=[summary.q1], median=[summary.median], q3=[summary.q3],
+                         lowerfence=[summary.lower_whisker], upperfence=[summary.upper_whisker],
+                         mean=[summary.mean], y=[column], orientation='h', name=''),
+                  row=1, col=1)
+    fig.add_trace(go.Scattergl(x=summary.outliers, y=[column] * len(summary.outliers), mode='markers',
+                               marker={'symbol': 'diamond', 'size': 5}, name='outliers'),
+                  row=1, col=1)
+    edges = summary.bin_edges
+    fig.add_trace(go.Bar(x=(edges[:-1] + edges[1:]) / 2, y=summary.bin_counts, width=edges[1] - edges[0],
+                         name='counties'),
+                  row=2, col=1)
+    fig.update_yaxes(showticklabels=False, row=1, col=1)
+    fig.update_xaxes(title_text=f'Variable: {column}', row=2, col=1)
+    fig.update_layout(title='Exploratory data analysis', showlegend=False,
+                      margin={"r":0,"t":40,"l":0,"b":0})
+    return fig
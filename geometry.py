@@ -0,0 +1,131 @@
+#simplified county geometries for the choropleth maps
+import numpy as np
+import shapely
+
+
+# zoom level -> (simplification tolerance, coordinate grid size), both in degrees
+LEVELS = {
+    'national': (0.05, 0.01),
+    'state': (0.004, 0.001),
+}
+
+
+def simplify(geoms, tolerance):
+    '''Simplify a set of polygons that tile an area (counties, tracts) together.'''
+    # coverage simplification keeps the shared borders between neighbouring
+    # counties identical, so no gaps or slivers open up between them (shapely 2.1+;
+    # simplifying each polygon on its own would open them)
+    return shapely.coverage_simplify(geoms, tolerance)
+
+
+def quantize(geoms, simplified, grid_size):
+    '''Snap simplified polygons to a grid_size coordinate grid.'''
+    quantized = shapely.set_precision(simplified, grid_size)
+    # very small counties can collapse on a coarse grid, keep them at full detail
+    for i in np.flatnonzero(shapely.is_empty(quantized)):
+        quantized[i] = shapely.set_precision(geoms[i], grid_size / 100)
+    return quantized
+
+
+class PackedGeometry:
+    '''Polygons as flat float32 coordinate and offset arrays instead of nested dicts.
+
+    Uses shapely's ragged array layout (everything promoted to MultiPolygon):
+    coords holds all vertices, offsets index rings -> polygons -> geometries.
+    GeoJSON is only materialized for the geometries a figure needs.
+    '''
+
+    def __init__(self, ids, geoms, grid_size):
+        self.ids = np.asarray(ids)
+        geometry_type, coords, offsets = shapely.to_ragged_array(shapely.multipolygons(
+            shapely.get_parts(geoms), indices=np.repeat(np.arange(len(geoms)), shapely.get_num_geometries(geoms))))
+        self.coords = coords.astype(np.float32)
+        self.offsets = tuple(o.astype(np.int32) for o in offsets)
+        self.decimals = max(int(round(-np.log10(grid_size))), 0)
+
+    @classmethod
+    def from_arrays(cls, ids, coords, offsets, decimals):
+        # e.g. memory mapped arrays saved by tiles.py
+        packed = cls.__new__(cls)
+        packed.ids, packed.coords, packed.offsets, packed.decimals = ids, coords, tuple(offsets), decimals
+        return packed
+
+    @property
+    def nbytes(self):
+        return self.ids.nbytes + self.coords.nbytes + sum(o.nbytes for o in self.offsets)
+
+    def rings(self, polygon):
+        '''Rings (exterior first) of one polygon part as rounded [lon, lat] lists.'''
+        rings, polygons, _ = self.offsets
+        return [np.round(self.coords[rings[r]:rings[r + 1]].astype(np.float64), self.decimals).tolist()
+                for r in range(polygons[polygon], polygons[polygon + 1])]
+
+    def feature_collection(self, indices=None):
+        if indices is None:
+            indices = np.arange(len(self.ids))
+        geometries = self.offsets[2]
+        features = []
+        for i in indices:
+            parts = [self.rings(p) for p in range(geometries[i], geometries[i + 1])]
+            geometry = ({'type': 'Polygon', 'coordinates': parts[0]} if len(parts) == 1
+                        else {'type': 'MultiPolygon', 'coordinates': parts})
+            features.append({'type': 'Feature', 'id': str(self.ids[i]), 'geometry': geometry})
+        return {'type': 'FeatureCollection', 'features': features}
+
+
+def total_bounds(geoms):
+    '''(min lon, min lat, max lon, max lat) of geometries in lon/lat.
+
+    For an area that crosses the antimeridian (Alaska's Aleutians) max lon is
+    past 180, so the box covers the area instead of the whole globe.
+    '''
+    lon, lat = shapely.get_coordinates(geoms).T
+    east = lon % 360
+    if np.ptp(east) < np.ptp(lon):
+        lon = east
+    return float(lon.min()), float(lat.min()), float(lon.max()), float(lat.max())
+
+
+class CountyGeometry:
+    '''Pre-simplified versions of counties.json, keyed by FIPS only.
+
+    Each level in LEVELS is built once for the whole country and kept as
+    packed coordinate arrays; per-state subsets (keyed by the two digit state
+    FIPS code) and their bounding boxes are index ranges into those arrays,
+    so a map only ships the geometry it actually shows.
+    '''
+
+    def __init__(self, counties, levels=LEVELS):
+        features = counties['features']
+        ids = np.array([f['id'] for f in features])
+        # sorted by FIPS, so every state is one contiguous block
+        order = np.argsort(ids, kind='stable')
+        self.ids = ids[order]
+        states = np.array([fips[:2] for fips in self.ids])
+        geoms = np.array([shapely.geometry.shape(features[i]['geometry']) for i in order], dtype=object)
+
+        self.levels = {}
+        for level, (tolerance, grid_size) in levels.items():
+            simplified = quantize(geoms, simplify(geoms, tolerance), grid_size)
+            self.levels[level] = PackedGeometry(self.ids, simplified, grid_size)
+
+        self.state_ranges = {}
+        self.bounds = {}
+        for state in np.unique(states):
+            members = np.flatnonzero(states == state)
+            self.state_ranges[str(state)] = (int(members[0]), int(members[-1]) + 1)
+            self.bounds[str(state)] = total_bounds(geoms[members])
+
+    @property
+    def nbytes(self):
+        return sum(packed.nbytes for packed in self.levels.values())
+
+    def national(self, level='national'):
+        return self.levels[level].feature_collection()
+
+    def state(self, state_fips, level='state'):
+        return self.levels[level].feature_collection(range(*self.state_ranges[state_fips]))
+
+    def state_bounds(self, state_fips):
+        # (min lon, min lat, max lon, max lat)
+        return self.bounds[state_fips]
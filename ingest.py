@@ -0,0 +1,147 @@
+#streaming ingestion of the raw AFDC alternative fuel station export
+import sys
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from datastore import frame_writer, load_frame, save_frame
+from spatial_join import join_areas, load_county_index, load_index
+
+
+CHUNKSIZE = 50_000
+
+# columns needed from the ~70 column export
+STATION_COLUMNS = ['ID', 'Fuel Type Code', 'Station Name', 'Street Address', 'City', 'State', 'ZIP',
+                   'EV Network', 'EV DC Fast Count', 'EV Level1 EVSE Num', 'EV Level2 EVSE Num',
+                   'Latitude', 'Longitude', 'Updated At']
+COUNT_COLUMNS = ['EV DC Fast Count', 'EV Level1 EVSE Num', 'EV Level2 EVSE Num']
+
+# what the next refresh needs to know about every station
+STATION_SCHEMA = pa.schema([('ID', pa.int64()), ('Updated At', pa.string()), ('FIPS', pa.string())])
+
+# one row per charging location, not per charger (see the 'Datasets' page)
+LOCATION_KEY = ['Street Address', 'City', 'EV Network']
+LOCATION_AGG = {
+    'Latitude': 'first',
+    'Longitude': 'first',
+    'EV DC Fast Count': 'sum',
+    'EV Level1 EVSE Num': 'sum',
+    'EV Level2 EVSE Num': 'sum',
+    'Station Name': 'first',
+    'State': 'first',
+    'ZIP': 'first',
+    'FIPS': 'first',
+}
+
+# columns of final_data.csv the county counts feed
+COUNTY_COLUMNS = {
+    'EV DC Fast Count': 'Number of Level 3 chargers',
+    'EV Level1 EVSE Num': 'Number of Level 1 chargers',
+    'EV Level2 EVSE Num': 'Number of Level 2 chargers',
+}
+
+# networks shown by name in the snapshot, the rest is summed up as 'Other'
+SNAPSHOT_NETWORKS = 8
+
+
+def read_stations(path, chunksize=CHUNKSIZE):
+    '''Stream the electric stations of a raw export in chunks of typed columns.'''
+    dtypes = {'ID': 'int64', 'Fuel Type Code': 'category', 'State': str,
+              'EV Network': str, 'ZIP': str, 'Updated At': str}
+    for chunk in pd.read_csv(path, usecols=STATION_COLUMNS, dtype=dtypes, chunksize=chunksize):
+        chunk = chunk[chunk['Fuel Type Code'] == 'ELEC'].drop(columns='Fuel Type Code')
+        chunk[COUNT_COLUMNS] = chunk[COUNT_COLUMNS].fillna(0).astype('int32')
+        yield chunk
+
+
+def _dedup(frame):
+    return frame.groupby(LOCATION_KEY, observed=True, sort=False).agg(LOCATION_AGG)
+
+
+def refresh(path, county_index=None, chunksize=CHUNKSIZE, tracts=None):
+    '''Ingest a raw station export, writing the location, snapshot and county tables.
+
+    tracts can name a (polygon file, id column) pair, e.g. tract shapes and
+    'GEOID', to also write charger totals per polygon as 'tract_chargers'.
+
+    Only stations that are new or whose 'Updated At' changed since the last
+    refresh are assigned to a county; everything else reuses the stored result.
+    Each chunk is folded into running aggregates (the deduplicated locations
+    and the station counts per state and network) and its station records
+    are appended to the store, so memory stays bounded by the chunk size plus
+    the number of locations.
+    '''
+    previous = load_frame('stations')
+    if previous is not None:
+        previous = previous.set_index('ID')
+
+    locations = None
+    networks = None
+    changed = 0
+    with frame_writer('stations', STATION_SCHEMA) as write_stations:
+        for chunk in read_stations(path, chunksize):
+            chunk['FIPS'] = None
+            todo = np.ones(len(chunk), dtype=bool)
+            if previous is not None:
+                known = previous.reindex(chunk['ID'])
+                unchanged = (known['Updated At'].to_numpy() == chunk['Updated At'].to_numpy())
+                chunk.loc[unchanged, 'FIPS'] = known['FIPS'].to_numpy()[unchanged]
+                todo = ~unchanged
+            if todo.any():
+                if county_index is None:
+                    county_index = load_county_index()
+                chunk.loc[todo, 'FIPS'] = county_index.assign(chunk.loc[todo, 'Longitude'],
+                                                              chunk.loc[todo, 'Latitude'])
+                changed += int(todo.sum())
+            write_stations(chunk[['ID', 'Updated At', 'FIPS']])
+
+            # 'first' and 'sum' are associative, so folding in one chunk at a time
+            # gives the same result as deduplicating the whole file at once
+            merged = _dedup(chunk) if locations is None else pd.concat([locations, _dedup(chunk)])
+            locations = _dedup(merged.reset_index())
+            counts = network_counts(chunk)
+            networks = counts if networks is None else networks.add(counts, fill_value=0)
+
+    if locations is None:
+        raise ValueError(f'no electric stations in {path}')
+    locations = locations.reset_index()
+    save_frame(locations, 'charger_locations')
+    # the snapshot counts stations before the address dedup, as the 'Datasets' page describes
+    save_frame(network_snapshot(networks), 'charger_snap')
+    save_frame(county_counts(locations), 'county_chargers')
+    if tracts is not None:
+        source, id_field = tracts
+        save_frame(join_areas(locations, load_index(source, id_field), id_field), 'tract_chargers')
+    return changed
+
+
+def network_counts(stations):
+    # station rows per state (rows) and network (columns)
+    return pd.crosstab(stations['State'], stations['EV Network'])
+
+
+def network_snapshot(counts, networks=SNAPSHOT_NETWORKS):
+    '''Stations per state and network, like charger_snap.csv, from network_counts().'''
+    counts = counts.fillna(0)
+    top = counts.sum().sort_values(ascending=False).index[:networks]
+    snapshot = counts[top].copy()
+    snapshot['Other'] = counts.drop(columns=top).sum(axis=1)
+    snapshot.insert(0, 'Total', counts.sum(axis=1))
+    snapshot = snapshot.sort_values('Total', ascending=False).astype('int64')
+    snapshot.columns.name = None
+    return snapshot.rename_axis('State').reset_index()
+
+
+def county_counts(locations):
+    '''Charger counts per county FIPS, named like the columns of final_data.csv.'''
+    located = locations.dropna(subset=['FIPS'])
+    counts = located.groupby('FIPS')[list(COUNTY_COLUMNS)].sum().rename(columns=COUNTY_COLUMNS)
+    counts['Number of stations'] = located.groupby('FIPS').size()
+    return counts.astype('int64').reset_index()
+
+
+if __name__ == '__main__':
+    # python ingest.py <station export> [<tract polygons> <id column>]
+    changed = refresh(sys.argv[1], tracts=tuple(sys.argv[2:4]) or None)
+    print(f'{changed} new or updated stations')
@@ -0,0 +1,148 @@
+#timing and memory spans around the stages of a dashboard rerun
+#
+# Set EV_DASHBOARD_TRACE_FILE to append every span as a JSON line (fields
+# follow the OpenTelemetry span layout) and EV_DASHBOARD_PROFILE=1 to show
+# the profiling panel in the sidebar.
+import json
+import os
+import secrets
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+TRACE_FILE = os.environ.get('EV_DASHBOARD_TRACE_FILE')
+PROFILE_PANEL = os.environ.get('EV_DASHBOARD_PROFILE') == '1'
+HISTORY = 20
+
+_local = threading.local()
+_history = deque(maxlen=HISTORY)
+_lock = threading.Lock()
+_page_size_kb = os.sysconf('SC_PAGE_SIZE') // 1024 if hasattr(os, 'sysconf') else 4
+
+
+_cache_counts = {}
+
+
+def count_cache(name, hit):
+    '''Count a hit or miss of a named cache (a cached loader or an on-disk cache).'''
+    with _lock:
+        counts = _cache_counts.setdefault(name, {'hits': 0, 'misses': 0})
+        counts['hits' if hit else 'misses'] += 1
+
+
+def cache_stats():
+    '''Hit and miss counts of every named cache of the process so far.'''
+    with _lock:
+        return {name: dict(counts) for name, counts in _cache_counts.items()}
+
+
+def rss_kb():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * _page_size_kb
+    except OSError:
+        return 0
+
+
+class Rerun:
+    def __init__(self):
+        self.trace_id = secrets.token_hex(16)
+        self.page = None
+        self.start = time.time_ns()
+        self.spans = []
+        self.stack = []
+
+
+def start_rerun():
+    '''Begin collecting spans for the script run on this thread.'''
+    _local.rerun = Rerun()
+
+
+def set_page(page):
+    rerun = getattr(_local, 'rerun', None)
+    if rerun is not None:
+        rerun.page = page
+
+
+@contextmanager
+def span(name, **attributes):
+    '''Time a stage of the current rerun; a no-op outside of a rerun.'''
+    rerun = getattr(_local, 'rerun', None)
+    if rerun is None:
+        yield
+        return
+    span_id = secrets.token_hex(8)
+    parent = rerun.stack[-1] if rerun.stack else None
+    rss = rss_kb()
+    start = time.time_ns()
+    rerun.stack.append(span_id)
+    try:
+        yield
+    finally:
+        rerun.stack.pop()
+        rerun.spans.append({
+            'trace_id': rerun.trace_id,
+            'span_id': span_id,
+            'parent_span_id': parent,
+            'name': name,
+            'start_time_unix_nano': start,
+            'end_time_unix_nano': time.time_ns(),
+            'attributes': {**attributes, 'rss_delta_kb': rss_kb() - rss},
+        })
+
+
+def record_span(name, start_time_unix_nano, **attributes):
+    '''Add a stage that ends now but started before it could be wrapped in span().'''
+    rerun = getattr(_local, 'rerun', None)
+    if rerun is None:
+        return
+    rerun.spans.append({
+        'trace_id': rerun.trace_id,
+        'span_id': secrets.token_hex(8),
+        'parent_span_id': rerun.stack[-1] if rerun.stack else None,
+        'name': name,
+        'start_time_unix_nano': start_time_unix_nano,
+        'end_time_unix_nano': time.time_ns(),
+        'attributes': attributes,
+    })
+
+
+def finish_rerun():
+    '''Close the current rerun, export its spans and keep it in the recent history.'''
+    rerun = getattr(_local, 'rerun', None)
+    if rerun is None:
+        return None
+    _local.rerun = None
+    record = {
+        'trace_id': rerun.trace_id,
+        'page': rerun.page,
+        'seconds': (time.time_ns() - rerun.start) / 1e9,
+        'spans': rerun.spans,
+    }
+    with _lock:
+        _history.append(record)
+        if TRACE_FILE:
+            with open(TRACE_FILE, 'a') as outfile:
+                for item in rerun.spans:
+                    outfile.write(json.dumps({**item, 'attributes': {**item['attributes'], 'page': rerun.page}}) + '\n')
+    return record
+
+
+def recent_reruns():
+    with _lock:
+        return list(_history)
+
+
+def stage_breakdown(reruns):
+    '''Seconds per top-level stage for each rerun, newest first.'''
+    rows = []
+    for rerun in reversed(reruns):
+        row = {'page': rerun['page'], 'total': rerun['seconds']}
+        for item in rerun['spans']:
+            if item['parent_span_id'] is None:
+                seconds = (item['end_time_unix_nano'] - item['start_time_unix_nano']) / 1e9
+                row[item['name']] = row.get(item['name'], 0) + seconds
+        rows.append(row)
+    return rows
@@ -0,0 +1,266 @@
+#k-means clustering of the county data, run inside the app
+import hashlib
+import json
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from datastore import STORE_DIR, load_table, temp_path
+from instrumentation import count_cache
+
+
+CACHE_DIR = os.path.join(STORE_DIR, 'kmeans')
+
+NUMERIC_FEATURES = [
+    '% of households with 2 or more cars',
+    'Number of Level 3 chargers', 'Number of Level 1 chargers',
+    'Number of Level 2 chargers',
+    '% of Non-Hispanic Black population',
+    '% of Hispanic population',
+    '% of the population in poverty',
+    '% of white population']
+PARTY_FEATURES = ['Political party (county)', 'Political party (state)']
+FEATURES = NUMERIC_FEATURES + PARTY_FEATURES
+PARTY_CODES = {'REPUBLICAN': 0, 'DEMOCRAT': 1}
+
+# column names used in cluster_stats.csv
+STATS_COLUMNS = {
+    'Political party (county)': 'Political party affiliation (county-level)',
+    '% of households with 2 or more cars': 'Vehicle ownership: percentage of households with 2 or more cars',
+    '% of Non-Hispanic Black population': 'Percentage of Non-Hispanic Black population',
+    '% of Hispanic population': 'Percentage of Hispanic population',
+    '% of the population in poverty': 'Percentage of the population below the poverty line',
+    '% of white population': 'Percentage of white population',
+}
+
+KMeansResult = namedtuple('KMeansResult', ['centroids', 'labels', 'sse', 'n_iter'])
+
+
+def feature_matrix(frame):
+    '''Feature matrix in FEATURES order, with the party columns coded as 0/1
+    and missing values left as NaN.'''
+    x = frame[FEATURES].copy()
+    for column in PARTY_FEATURES:
+        x[column] = x[column].astype(str).map(PARTY_CODES)
+    return x.to_numpy(dtype=np.float64)
+
+
+def prepare_features(frame, fill=None):
+    '''feature_matrix() with missing values filled with fill (one value per
+    feature), by default the column mean (0 after standardizing).'''
+    x = feature_matrix(frame)
+    fill = np.nanmean(x, axis=0) if fill is None else np.asarray(fill, dtype=np.float64)
+    return np.where(np.isnan(x), fill, x)
+
+
+def standardize(x):
+    # same as sklearn's StandardScaler: population std, constant columns left unscaled
+    means = x.mean(axis=0)
+    stds = x.std(axis=0)
+    stds[stds == 0] = 1.0
+    return (x - means) / stds, means, stds
+
+
+def assign(x, centroids, batch_size=8192):
+    '''Nearest centroid and squared distance for every row, in row batches.'''
+    labels = np.empty(len(x), dtype=np.int64)
+    distances = np.empty(len(x))
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    for start in range(0, len(x), batch_size):
+        batch = x[start:start + batch_size]
+        # |x - c|^2 = |x|^2 - 2 x.c + |c|^2, one matrix product per batch
+        d = (batch ** 2).sum(axis=1)[:, None] - 2 * batch @ centroids.T + centroid_norms
+        labels[start:start + batch_size] = d.argmin(axis=1)
+        distances[start:start + batch_size] = np.maximum(d.min(axis=1), 0)
+    return labels, distances
+
+
+def _cluster_sums(x, labels, k):
+    counts = np.bincount(labels, minlength=k)
+    sums = np.column_stack([np.bincount(labels, weights=x[:, j], minlength=k)
+                            for j in range(x.shape[1])])
+    return sums, counts
+
+
+def init_centroids(x, k, init, rng):
+    if init == 'random':
+        return x[rng.choice(len(x), k, replace=False)].copy()
+    if init != 'k-means++':
+        raise ValueError(f'Unknown init method: {init}')
+    centroids = [x[rng.integers(len(x))]]
+    distances = ((x - centroids[0]) ** 2).sum(axis=1)
+    for _ in range(1, k):
+        total = distances.sum()
+        if total == 0:
+            idx = rng.integers(len(x))
+        else:
+            idx = rng.choice(len(x), p=distances / total)
+        centroids.append(x[idx])
+        distances = np.minimum(distances, ((x - x[idx]) ** 2).sum(axis=1))
+    return np.array(centroids)
+
+
+def _lloyd(x, centroids, max_iter, tol):
+    k = len(centroids)
+    for n_iter in range(1, max_iter + 1):
+        labels, distances = assign(x, centroids)
+        sums, counts = _cluster_sums(x, labels, k)
+        new = centroids.copy()
+        filled = counts > 0
+        new[filled] = sums[filled] / counts[filled, None]
+        # reseed empty clusters with the points furthest from their centroid
+        for c, idx in zip(np.flatnonzero(~filled), np.argsort(distances)[::-1]):
+            new[c] = x[idx]
+        shift = ((new - centroids) ** 2).sum()
+        centroids = new
+        if shift <= tol:
+            break
+    return centroids, n_iter
+
+
+def _mini_batch(x, centroids, max_iter, tol, batch_size, rng):
+    k = len(centroids)
+    seen = np.zeros(k)
+    for n_iter in range(1, max_iter + 1):
+        batch = x[rng.choice(len(x), min(batch_size, len(x)), replace=False)]
+        labels, _ = assign(batch, centroids)
+        sums, counts = _cluster_sums(batch, labels, k)
+        seen += counts
+        filled = counts > 0
+        # per-centroid learning rate shrinks with the number of points seen so far
+        rate = counts[filled] / seen[filled]
+        new = centroids.copy()
+        new[filled] = (1 - rate[:, None]) * centroids[filled] + rate[:, None] * sums[filled] / counts[filled, None]
+        shift = ((new - centroids) ** 2).sum()
+        centroids = new
+        if shift <= tol:
+            break
+    return centroids, n_iter
+
+
+def _relabel_by_size(centroids, labels):
+    # number clusters from largest to smallest so labels are stable between runs
+    order = np.argsort(-np.bincount(labels, minlength=len(centroids)), kind='stable')
+    mapping = np.empty_like(order)
+    mapping[order] = np.arange(len(order))
+    return centroids[order], mapping[labels]
+
+
+def fit(x, k, init='k-means++', n_init=4, max_iter=300, tol=1e-4, batch_size=None, seed=0):
+    '''Fit k-means on a (standardized) feature matrix, keeping the best of n_init runs.
+
+    With batch_size set, centroids are updated from random mini-batches
+    instead of full passes over the data.
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    rng = np.random.default_rng(seed)
+    # tolerance relative to the data's spread, like sklearn
+    tol = tol * x.var(axis=0).mean()
+    best = None
+    for _ in range(n_init):
+        centroids = init_centroids(x, k, init, rng)
+        if batch_size:
+            centroids, n_iter = _mini_batch(x, centroids, max_iter, tol, batch_size, rng)
+        else:
+            centroids, n_iter = _lloyd(x, centroids, max_iter, tol)
+        labels, distances = assign(x, centroids)
+        sse = float(distances.sum())
+        if best is None or sse < best.sse:
+            best = KMeansResult(centroids, labels, sse, n_iter)
+    centroids, labels = _relabel_by_size(best.centroids, best.labels)
+    return best._replace(centroids=centroids, labels=labels)
+
+
+def _fit_sse(args):
+    x, k, params = args
+    return fit(x, k, **params).sse
+
+
+def sse_sweep(x, ks, processes=None, **params):
+    '''SSE for every k in ks, fitted in parallel worker processes (elbow curve).'''
+    ks = list(ks)
+    jobs = [(x, k, params) for k in ks]
+    if processes == 1:
+        return np.array([_fit_sse(job) for job in jobs])
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        return np.array(list(pool.map(_fit_sse, jobs)))
+
+
+def elbow(ks, sse):
+    '''k where the SSE curve bends most: the furthest point below the line from
+    its first to its last point, with both axes scaled to [0, 1].'''
+    ks = np.asarray(ks, dtype=np.float64)
+    sse = np.asarray(sse, dtype=np.float64)
+    k = (ks - ks[0]) / max(ks[-1] - ks[0], 1)
+    y = (sse - sse.min()) / max(sse.max() - sse.min(), 1e-12)
+    return int(ks[np.argmax((1 - k) - y)])
+
+
+def _cache_path(kind, x, params):
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(x, dtype=np.float64).tobytes())
+    digest.update(str(x.shape).encode())
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    return os.path.join(CACHE_DIR, f'{kind}-{digest.hexdigest()}.npz')
+
+
+def cached_fit(x, k, **params):
+    '''fit(), cached on disk by a hash of the data and the parameters.'''
+    path = _cache_path('fit', x, {'k': k, **params})
+    count_cache('kmeans_fit', hit=os.path.exists(path))
+    if os.path.exists(path):
+        with np.load(path) as cached:
+            return KMeansResult(cached['centroids'], cached['labels'],
+                                float(cached['sse']), int(cached['n_iter']))
+    result = fit(x, k, **params)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp = temp_path(path)
+    np.savez(tmp, **result._asdict())
+    os.replace(tmp, path)
+    return result
+
+
+def cached_sse_sweep(x, ks, processes=None, **params):
+    '''sse_sweep(), cached on disk by a hash of the data and the parameters.'''
+    ks = list(ks)
+    path = _cache_path('sweep', x, {'ks': ks, **params})
+    count_cache('kmeans_sweep', hit=os.path.exists(path))
+    if os.path.exists(path):
+        with np.load(path) as cached:
+            return cached['sse']
+    sse = sse_sweep(x, ks, processes=processes, **params)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp = temp_path(path)
+    np.savez(tmp, sse=sse)
+    os.replace(tmp, path)
+    return sse
+
+
+def results_table(frame, labels):
+    '''County table with cluster labels, laid out like clustering_results.csv.'''
+    columns = ['State', 'County'] + PARTY_FEATURES + ['FIPS'] + NUMERIC_FEATURES + ['State abbreviation']
+    results = frame[columns].copy()
+    results.insert(0, 'Cluster', labels)
+    return results
+
+
+def cluster_summary(frame, labels):
+    '''Per-cluster means and member states, laid out like cluster_stats.csv.'''
+    x = frame[['Political party (county)'] + NUMERIC_FEATURES].copy()
+    x['Political party (county)'] = x['Political party (county)'].astype(str).map(PARTY_CODES)
+    x['Cluster'] = labels
+    summary = x.groupby('Cluster').mean()
+    summary['State'] = (frame['State abbreviation'].astype(str)
+                        .groupby(labels).unique().str.join(', '))
+    return summary.rename(columns=STATS_COLUMNS).reset_index()
+
+
+if __name__ == '__main__':
+    # regenerate the clustering result files from final_data.csv
+    data = load_table('Input files/final_data.csv')
+    x, _, _ = standardize(prepare_features(data))
+    result = cached_fit(x, 7)
+    results_table(data, result.labels).to_csv('Input files/clustering_results.csv', index=False)
+    cluster_summary(data, result.labels).to_csv('Input files/cluster_stats.csv', index=False)
@@ -0,0 +1,113 @@
+#page -> dataset registry, so a page only loads the data it uses
+import functools
+import threading
+import time
+
+import pandas as pd
+
+from instrumentation import count_cache, record_span, span
+
+
+# import time of this module, i.e. close to the first rerun of the process
+PROCESS_START = time.time()
+
+# most recent time-to-first-paint per page, see report_first_paint
+first_paint = {}
+
+# whether the body of the innermost cached_resource call on this thread ran
+_running = threading.local()
+
+
+def cached_resource(function=None, **options):
+    '''st.cache_resource that also counts its hits and misses (see instrumentation.cache_stats).
+
+    A call is a miss when the function body runs, so a cached loader that
+    gets evicted and rebuilt shows up as a miss, not a hit.
+    '''
+    if function is None:
+        return lambda function: cached_resource(function, **options)
+    import streamlit as st
+
+    @functools.wraps(function)
+    def body(*args, **kwargs):
+        _running.ran = True
+        return function(*args, **kwargs)
+    cached = st.cache_resource(**options)(body)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        # cached loaders call each other, so keep the flag of the outer call
+        outer = getattr(_running, 'ran', False)
+        _running.ran = False
+        try:
+            return cached(*args, **kwargs)
+        finally:
+            count_cache(function.__name__, hit=not _running.ran)
+            _running.ran = outer
+    wrapper.clear = cached.clear
+    return wrapper
+
+
+class DatasetRegistry:
+    '''Named dataset loaders plus the datasets each page declares it needs.
+
+    Nothing is loaded until a page accesses a dataset, so the text-only pages
+    never pay for reading tables or geometry.
+    '''
+
+    def __init__(self, pages):
+        self.pages = {page: tuple(names) for page, names in pages.items()}
+        self._loaders = {}
+
+    def register(self, name):
+        def decorator(loader):
+            self._loaders[name] = loader
+            return loader
+        return decorator
+
+    def for_page(self, page):
+        missing = [name for name in self.pages[page] if name not in self._loaders]
+        if missing:
+            raise KeyError(f'No loader registered for {missing} (page {page!r})')
+        return PageData(self._loaders, self.pages[page])
+
+
+class PageData:
+    '''The datasets of one page, each loaded on first access.
+
+    Tables are cached once per process and shared by all sessions, so a page
+    gets a shallow copy: with copy-on-write, adding or changing its columns
+    only changes that copy.
+    '''
+
+    def __init__(self, loaders, names):
+        self._loaders = loaders
+        self._names = names
+        self._loaded = {}
+
+    def __getitem__(self, name):
+        if name not in self._names:
+            raise KeyError(f'{name!r} is not declared for this page')
+        if name not in self._loaded:
+            with span(f'load {name}'):
+                self._loaded[name] = self._loaders[name]()
+        value = self._loaded[name]
+        if isinstance(value, (pd.DataFrame, pd.Series)):
+            return value.copy(deep=False)
+        return value
+
+
+def report_first_paint(page, started):
+    '''Record how long a rerun took from script start until the page was drawn.
+
+    Kept per page in first_paint and added to the rerun as a 'first_paint'
+    span, so it shows in the trace file and the profiling panel. The first
+    rerun of a process is flagged as cold: it also pays for the imports and
+    data loading that later reruns get from the caches.
+    '''
+    seconds = time.perf_counter() - started
+    cold = not first_paint
+    first_paint[page] = {'seconds': seconds, 'cold': cold}
+    record_span('first_paint', time.time_ns() - int(seconds * 1e9), page=page, cold=cold,
+                since_process_start=time.time() - PROCESS_START)
+    return seconds
@@ -0,0 +1,32 @@
+#compact, read-only tables shared by every session of a process
+import pandas as pd
+
+# store tables are written compact at ingest; compact() is for the tables read
+# straight from CSV or GeoPackage
+from datastore import compact
+from instrumentation import rss_kb
+
+
+# the tables registered here are the same objects in every session; pages get
+# shallow copies of them (see registry.PageData), which copy-on-write keeps from
+# writing through to the shared data (enabled in dashboard.py)
+
+_tables = {}
+
+
+def share(name, table):
+    '''Register a process-wide table so memory_report() can account for it.'''
+    _tables[name] = table
+    return table
+
+
+def _nbytes(table):
+    if isinstance(table, pd.DataFrame):
+        return int(table.memory_usage(deep=True, index=True).sum())
+    return int(getattr(table, 'nbytes', 0))
+
+
+def memory_report():
+    '''Resident memory of this replica and the size of each shared table, in bytes.'''
+    tables = {name: _nbytes(table) for name, table in _tables.items()}
+    return {'rss': rss_kb() * 1024, 'shared_tables': sum(tables.values()), 'tables': tables}
@@ -0,0 +1,191 @@
+#indexed point-in-polygon joins of charger locations to counties and tracts
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from datastore import ID_COLUMNS, STORE_DIR, temp_path
+from instrumentation import count_cache
+
+
+INDEX_DIR = os.path.join(STORE_DIR, 'spatial')
+
+BATCH_SIZE = 100_000
+# below this many points a process pool costs more than it saves
+PARALLEL_THRESHOLD = 200_000
+
+# marks where each area's network list starts, see aggregate_by_area
+RECORD_SEPARATOR = '\x1e'
+
+# per-area aggregation of the charger locations (see the 'Datasets' page)
+AREA_AGG = {
+    'EV DC Fast Count': 'sum',
+    'EV Level1 EVSE Num': 'sum',
+    'EV Level2 EVSE Num': 'sum',
+    'Station Name': 'first',
+    'City': 'first',
+    'Street Address': 'first',
+    'State': 'first',
+    'ZIP': 'first',
+}
+
+
+class PolygonIndex:
+    '''STRtree over a set of polygons, assigning points to the polygon containing them.'''
+
+    def __init__(self, ids, geoms):
+        self.ids = np.asarray(ids)
+        self.geoms = np.asarray(geoms, dtype=object)
+        shapely.prepare(self.geoms)
+        self.tree = shapely.STRtree(self.geoms)
+
+    def __getstate__(self):
+        # the tree is not picklable, workers rebuild it from the geometries
+        return {'ids': self.ids, 'wkb': shapely.to_wkb(self.geoms)}
+
+    def __setstate__(self, state):
+        self.__init__(state['ids'], shapely.from_wkb(state['wkb']))
+
+    def locate(self, longitude, latitude, batch_size=BATCH_SIZE):
+        '''Position of the polygon containing each point, -1 if there is none.'''
+        longitude = np.asarray(longitude, dtype=float)
+        latitude = np.asarray(latitude, dtype=float)
+        positions = np.full(len(longitude), -1, dtype=np.int64)
+        for start in range(0, len(longitude), batch_size):
+            points = shapely.points(longitude[start:start + batch_size], latitude[start:start + batch_size])
+            point_idx, polygon_idx = self.tree.query(points, predicate='intersects')
+            # points on a shared border touch two polygons, keep the first one
+            point_idx, first = np.unique(point_idx, return_index=True)
+            positions[start + point_idx] = polygon_idx[first]
+        return positions
+
+    def assign(self, longitude, latitude, processes=None, batch_size=BATCH_SIZE):
+        '''Id of the polygon containing each point (None outside every polygon).
+
+        Large point sets are split across worker processes, each of which
+        receives the index once and handles a contiguous slice of the points.
+        '''
+        longitude = np.asarray(longitude, dtype=float)
+        latitude = np.asarray(latitude, dtype=float)
+        if processes == 1 or len(longitude) < PARALLEL_THRESHOLD:
+            positions = self.locate(longitude, latitude, batch_size)
+        else:
+            workers = processes or os.cpu_count() or 1
+            slices = np.array_split(np.arange(len(longitude)), workers)
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(self,)) as pool:
+                parts = pool.map(_locate_in_worker,
+                                 [(longitude[s], latitude[s], batch_size) for s in slices])
+                positions = np.concatenate(list(parts))
+        ids = np.full(len(positions), None, dtype=object)
+        found = positions >= 0
+        ids[found] = self.ids[positions[found]]
+        return ids
+
+
+_worker_index = None
+
+
+def _init_worker(index):
+    global _worker_index
+    _worker_index = index
+
+
+def _locate_in_worker(args):
+    return _worker_index.locate(*args)
+
+
+def _index_path(source, id_field):
+    key = f'{os.path.abspath(source)}:{id_field}:{os.path.getmtime(source)}'
+    return os.path.join(INDEX_DIR, hashlib.sha1(key.encode()).hexdigest() + '.npz')
+
+
+def read_polygons(source, id_field):
+    '''Ids and polygons of a GeoJSON or GeoPackage file.
+
+    Ids are strings (zero padded like the store's FIPS/GEOID columns) and
+    polygons are in lon/lat, whatever the source file uses.
+    '''
+    if source.endswith('.json') or source.endswith('.geojson'):
+        with open(source, 'r') as infile:
+            features = json.load(infile)['features']
+        ids = np.array([f['id'] if id_field == 'id' else f['properties'][id_field] for f in features])
+        geoms = np.array([shapely.geometry.shape(f['geometry']) for f in features], dtype=object)
+    else:
+        import geopandas as gpd
+        polygons = gpd.read_file(source)
+        if polygons.crs is not None and not polygons.crs.equals('EPSG:4326'):
+            polygons = polygons.to_crs('EPSG:4326')
+        ids, geoms = polygons[id_field].to_numpy(), polygons.geometry.to_numpy()
+    if id_field in ID_COLUMNS and np.issubdtype(ids.dtype, np.number):
+        ids = np.char.zfill(ids.astype(np.int64).astype(str), ID_COLUMNS[id_field])
+    return ids.astype(str), geoms
+
+
+_indexes = {}
+
+
+def load_index(source, id_field):
+    '''Polygon index for a GeoJSON or GeoPackage file, built once and kept.
+
+    The polygons are stored as WKB under the store directory, so later
+    processes skip parsing the source file, and each process keeps its index.
+    '''
+    path = _index_path(source, id_field)
+    # a hit when the index is in memory or on disk
+    count_cache('polygon_index', hit=path in _indexes or os.path.exists(path))
+    if path not in _indexes:
+        if os.path.exists(path):
+            with np.load(path, allow_pickle=False) as cached:
+                ids, blob, offsets = cached['ids'], cached['blob'].tobytes(), cached['offsets']
+            geoms = shapely.from_wkb([blob[a:b] for a, b in zip(offsets[:-1], offsets[1:])])
+        else:
+            ids, geoms = read_polygons(source, id_field)
+            # one byte buffer plus offsets, so the file loads without pickle
+            wkb = shapely.to_wkb(geoms)
+            offsets = np.concatenate([[0], np.cumsum([len(w) for w in wkb])])
+            os.makedirs(INDEX_DIR, exist_ok=True)
+            tmp = temp_path(path)
+            np.savez(tmp, ids=ids.astype(str), offsets=offsets,
+                     blob=np.frombuffer(b''.join(wkb), dtype=np.uint8))
+            os.replace(tmp, path)
+        # str ids whether they were just read or come from the cache
+        _indexes[path] = PolygonIndex(ids.astype(str), geoms)
+    return _indexes[path]
+
+
+def load_county_index(filename='Input files/counties.json'):
+    return load_index(filename, 'id')
+
+
+def aggregate_by_area(locations, area_column):
+    '''Sum charger counts per area and list the networks present in each one.
+
+    The network lists are built without a Python call per area: the distinct
+    (area, network) pairs are sorted by area, every name gets a ', ' prefix or,
+    for the first of its area, RECORD_SEPARATOR, and one join plus one split
+    turns them into one string per area.
+    '''
+    located = locations.dropna(subset=[area_column])
+    per_area = located.groupby(area_column).agg(AREA_AGG)
+    networks = (located[[area_column, 'EV Network']].dropna()
+                .drop_duplicates(keep='first')
+                .sort_values(area_column, kind='stable'))
+    first = networks.groupby(area_column, sort=False).cumcount().to_numpy() == 0
+    names = networks['EV Network'].astype(str)
+    # the ASCII record separator does not occur in network names, so it marks where
+    # the next area starts
+    pieces = pd.Series(np.where(first, RECORD_SEPARATOR, ', '), index=names.index) + names
+    lists = ''.join(pieces.tolist()).split(RECORD_SEPARATOR)[1:]
+    per_area['EV Network'] = pd.Series(lists, index=networks[area_column].to_numpy()[first])
+    return per_area.reset_index()
+
+
+def join_areas(locations, index, area_column, processes=None):
+    '''Assign every charger location to an area of the index and aggregate per area.'''
+    locations = locations.assign(**{area_column: index.assign(locations['Longitude'], locations['Latitude'],
+                                                              processes=processes)})
+    return aggregate_by_area(locations, area_column)
@@ -0,0 +1,264 @@
+#sparse spatial weights, global Moran's I and local (LISA) hot spot statistics
+import hashlib
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import scipy.sparse as sparse
+import shapely
+from scipy.spatial import cKDTree
+
+from datastore import STORE_DIR, temp_path
+from instrumentation import count_cache
+from spatial_join import read_polygons
+
+
+WEIGHTS_DIR = os.path.join(STORE_DIR, 'weights')
+
+# vertices closer than this (in degrees) count as the same point when matching borders
+GRID_SIZE = 1e-7
+PERMUTATIONS = 999
+SIGNIFICANCE = 0.05
+# observations per vectorized block of conditional permutations
+BATCH_SIZE = 256
+# below this many observations a process pool costs more than it saves
+PARALLEL_THRESHOLD = 20_000
+
+# LISA quadrant of each observation, from its own value and its neighbours' (high/low)
+QUADRANTS = {1: 'Hot spot', 2: 'Low-high outlier', 3: 'Cold spot', 4: 'High-low outlier'}
+NOT_SIGNIFICANT = 'Not significant'
+
+MoranResult = namedtuple('MoranResult', ['I', 'expected', 'z_score', 'p_value'])
+LisaResult = namedtuple('LisaResult', ['I', 'quadrant', 'p_value', 'label'])
+
+
+class SpatialWeights:
+    '''Binary neighbour matrix of a set of polygons, as a scipy CSR matrix.
+
+    Rows and columns follow ids. Polygons without neighbours (islands) have
+    empty rows and drop out of the statistics.
+    '''
+
+    def __init__(self, ids, matrix, kind):
+        self.ids = np.asarray(ids)
+        self.matrix = sparse.csr_matrix(matrix, dtype=np.float64)
+        self.kind = kind
+
+    @property
+    def n(self):
+        return len(self.ids)
+
+    @property
+    def cardinalities(self):
+        return np.diff(self.matrix.indptr)
+
+    @property
+    def islands(self):
+        return self.ids[self.cardinalities == 0]
+
+    def subset(self, ids):
+        '''Weights between the given ids only, in that order; unknown ids become islands.'''
+        position = {id_: i for i, id_ in enumerate(self.ids)}
+        idx = np.array([position.get(id_, -1) for id_ in ids], dtype=np.int64)
+        # selecting with a sparse 0/1 matrix keeps the rows and columns of unknown ids empty
+        known = np.flatnonzero(idx >= 0)
+        select = sparse.csr_matrix((np.ones(len(known)), (idx[known], known)), shape=(self.n, len(idx)))
+        return SpatialWeights(ids, select.T @ self.matrix @ select, self.kind)
+
+    def row_standardized(self):
+        sums = np.asarray(self.matrix.sum(axis=1)).ravel()
+        scale = np.divide(1.0, sums, out=np.zeros_like(sums), where=sums > 0)
+        return sparse.diags(scale) @ self.matrix
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        matrix = self.matrix.tocsr()
+        tmp = temp_path(path)
+        np.savez(tmp, ids=self.ids.astype(str), indptr=matrix.indptr, indices=matrix.indices,
+                 kind=np.array(self.kind))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as cached:
+            ids, indptr, indices = cached['ids'], cached['indptr'], cached['indices']
+            matrix = sparse.csr_matrix((np.ones(len(indices)), indices, indptr), shape=(len(ids), len(ids)))
+            return cls(ids, matrix, str(cached['kind']))
+
+
+def _shared(owner, keys, n):
+    # polygons x keys incidence matrix; two polygons are neighbours when they share a key
+    pairs = np.unique(np.stack([owner, keys], axis=1), axis=0)
+    incidence = sparse.csr_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])),
+                                  shape=(n, int(keys.max()) + 1 if len(keys) else 0))
+    shared = (incidence @ incidence.T).tocsr()
+    shared.setdiag(0)
+    shared.eliminate_zeros()
+    shared.data[:] = 1.0
+    return shared
+
+
+def contiguity(geoms, kind='queen', grid_size=GRID_SIZE):
+    '''Queen (shared vertex) or rook (shared edge) neighbour matrix of polygons.
+
+    Vertices are snapped to grid_size and hashed, so neighbours are found by
+    one sparse product of the polygon -> vertex (or edge) incidence matrix
+    with itself instead of pairwise geometry tests. Borders must share their
+    vertices, as in a topologically clean coverage such as counties.json.
+    '''
+    geometry_type, coords, (rings, polygons, geometries) = shapely.to_ragged_array(shapely.multipolygons(
+        shapely.get_parts(geoms), indices=np.repeat(np.arange(len(geoms)), shapely.get_num_geometries(geoms))))
+    # owning polygon (input geometry) of every vertex
+    ring_owner = np.repeat(np.arange(len(geometries) - 1), np.diff(polygons[geometries]))
+    owner = np.repeat(ring_owner, np.diff(rings))
+    _, vertex = np.unique(np.round(coords / grid_size).astype(np.int64), axis=0, return_inverse=True)
+    vertex = vertex.ravel()
+    if kind == 'queen':
+        return _shared(owner, vertex, len(geoms))
+    if kind != 'rook':
+        raise ValueError(f'unknown contiguity {kind!r}')
+    # an edge joins two consecutive vertices of a ring, in either direction
+    last = np.zeros(len(coords), dtype=bool)
+    last[rings[1:] - 1] = True
+    keep = ~last[:-1] & (vertex[:-1] != vertex[1:])
+    _, edge = np.unique(np.sort(np.stack([vertex[:-1][keep], vertex[1:][keep]], axis=1), axis=1),
+                        axis=0, return_inverse=True)
+    return _shared(owner[:-1][keep], edge.ravel(), len(geoms))
+
+
+def nearest(geoms, k=8):
+    '''k nearest neighbours by the distance between representative points.'''
+    lon, lat = np.radians(shapely.get_coordinates(shapely.point_on_surface(geoms))).T
+    # points on the unit sphere, so distances do not depend on latitude
+    xyz = np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=1)
+    k = min(k, len(geoms) - 1)
+    _, neighbours = cKDTree(xyz).query(xyz, k=k + 1)
+    # the nearest point of every polygon is its own
+    rows = np.repeat(np.arange(len(geoms)), k)
+    return sparse.csr_matrix((np.ones(len(rows)), (rows, neighbours[:, 1:].ravel())), shape=(len(geoms),) * 2)
+
+
+def _weights_path(source, id_field, kind, k):
+    key = f'{os.path.abspath(source)}:{id_field}:{os.path.getmtime(source)}:{kind}:{k}:{GRID_SIZE}'
+    return os.path.join(WEIGHTS_DIR, hashlib.sha1(key.encode()).hexdigest() + '.npz')
+
+
+def load_weights(source, id_field, kind='queen', k=8):
+    '''Spatial weights of a GeoJSON or GeoPackage file ('queen', 'rook' or 'knn'), built once.'''
+    path = _weights_path(source, id_field, kind, k)
+    count_cache('spatial_weights', hit=os.path.exists(path))
+    if os.path.exists(path):
+        return SpatialWeights.load(path)
+    ids, geoms = read_polygons(source, id_field)
+    matrix = nearest(geoms, k) if kind == 'knn' else contiguity(geoms, kind)
+    weights = SpatialWeights(ids, matrix, kind if kind != 'knn' else f'knn{k}')
+    weights.save(path)
+    return weights
+
+
+def moran(values, weights, permutations=PERMUTATIONS, batch_size=100, seed=0):
+    '''Global Moran's I with a permutation test on row standardized weights.
+
+    Permutations are evaluated batch_size at a time as one sparse product
+    with a matrix of shuffled values.
+    '''
+    w = weights.row_standardized()
+    z = np.asarray(values, dtype=np.float64)
+    z = z - z.mean()
+    n, s0 = len(z), w.sum()
+    scale = n / s0 / (z @ z)
+    observed = scale * (z @ (w @ z))
+    rng = np.random.default_rng(seed)
+    simulated = []
+    for start in range(0, permutations, batch_size):
+        shuffled = rng.permuted(np.tile(z[:, None], (1, min(batch_size, permutations - start))), axis=0)
+        simulated.append(scale * (shuffled * (w @ shuffled)).sum(axis=0))
+    simulated = np.concatenate(simulated)
+    larger = int((simulated >= observed).sum())
+    larger = min(larger, permutations - larger)
+    return MoranResult(float(observed), -1 / (n - 1), float((observed - simulated.mean()) / simulated.std()),
+                       (larger + 1) / (permutations + 1))
+
+
+def _padded_neighbours(w):
+    # CSR rows as (n, max neighbours) arrays of column indices and weights, 0 weight as padding
+    counts = np.diff(w.indptr)
+    width = max(int(counts.max()) if len(counts) else 0, 1)
+    rows = np.repeat(np.arange(w.shape[0]), counts)
+    slots = np.arange(len(w.indices)) - w.indptr[rows]
+    columns = np.zeros((w.shape[0], width), dtype=np.int64)
+    values = np.zeros((w.shape[0], width))
+    columns[rows, slots] = w.indices
+    values[rows, slots] = w.data
+    return values, counts
+
+
+def _local_block(z, draws, values, start, stop):
+    # simulated local I for observations start..stop: each one keeps its own value
+    # and gets its neighbours' values from the same random draws of the other n - 1
+    # observations (index >= i is shifted by one to skip i itself)
+    own = np.arange(start, stop)[:, None, None]
+    idx = draws[None, :, :values.shape[1]]
+    idx = idx + (idx >= own)
+    lag = (z[idx] * values[start:stop, None, :]).sum(axis=2)
+    return z[start:stop, None] * lag
+
+
+def _local_pvalues(z, m2, observed, draws, values, start, stop, batch_size=BATCH_SIZE):
+    p = np.empty(stop - start)
+    permutations = len(draws)
+    for block in range(start, stop, batch_size):
+        end = min(block + batch_size, stop)
+        simulated = _local_block(z, draws, values, block, end) / m2
+        larger = (simulated >= observed[block:end, None]).sum(axis=1)
+        larger = np.minimum(larger, permutations - larger)
+        p[block - start:end - start] = (larger + 1) / (permutations + 1)
+    return p
+
+
+_worker_args = None
+
+
+def _init_worker(*args):
+    global _worker_args
+    _worker_args = args
+
+
+def _pvalues_in_worker(bounds):
+    return _local_pvalues(*_worker_args, *bounds)
+
+
+def lisa(values, weights, permutations=PERMUTATIONS, significance=SIGNIFICANCE, processes=None, seed=0):
+    '''Local Moran's I of every observation with a conditional permutation test.
+
+    The random draws are shared by all observations (as PySAL does), so a
+    block of BATCH_SIZE observations times all permutations is evaluated in
+    one vectorized step. Large inputs are split over worker processes.
+    '''
+    w = weights.row_standardized().tocsr()
+    z = np.asarray(values, dtype=np.float64)
+    z = z - z.mean()
+    n = len(z)
+    m2 = (z @ z) / n
+    lag = w @ z
+    observed = z * lag / m2
+    quadrant = np.where(z > 0, np.where(lag > 0, 1, 4), np.where(lag > 0, 2, 3))
+
+    neighbour_weights, counts = _padded_neighbours(w)
+    rng = np.random.default_rng(seed)
+    width = neighbour_weights.shape[1]
+    # one sample without replacement of neighbour positions per permutation
+    draws = np.stack([rng.choice(n - 1, size=width, replace=False) for _ in range(permutations)])
+    args = (z, m2, observed, draws, neighbour_weights)
+    if processes == 1 or n < PARALLEL_THRESHOLD:
+        p = _local_pvalues(*args, 0, n)
+    else:
+        workers = processes or os.cpu_count() or 1
+        edges = np.linspace(0, n, workers + 1).astype(int)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=args) as pool:
+            p = np.concatenate(list(pool.map(_pvalues_in_worker, zip(edges[:-1], edges[1:]))))
+    # islands have no neighbours to compare with
+    p[counts == 0] = 1.0
+    label = np.where(p <= significance, np.vectorize(QUADRANTS.get)(quadrant), NOT_SIGNIFICANT)
+    return LisaResult(observed, quadrant, p, label)
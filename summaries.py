@@ -0,0 +1,51 @@
+#distribution summaries (box plot and histogram inputs) for every numeric column
+from collections import namedtuple
+
+import numpy as np
+
+
+HISTOGRAM_BINS = 30
+
+Summary = namedtuple('Summary', ['count', 'mean', 'q1', 'median', 'q3',
+                                 'lower_whisker', 'upper_whisker', 'outliers',
+                                 'bin_edges', 'bin_counts'])
+
+
+def summarize(frame, bins=HISTOGRAM_BINS):
+    '''Summaries for all numeric columns of a table, computed column-wise in one pass.
+
+    Whiskers follow the usual box plot rule (furthest value within 1.5 IQR
+    of the box), values beyond them are kept as outliers. Missing values are
+    ignored.
+    '''
+    numeric = frame.select_dtypes('number')
+    x = numeric.to_numpy(dtype=np.float64)
+    valid = ~np.isnan(x)
+
+    q1, median, q3 = np.nanpercentile(x, [25, 50, 75], axis=0)
+    iqr = q3 - q1
+    low_fence = q1 - 1.5 * iqr
+    high_fence = q3 + 1.5 * iqr
+    lower_whisker = np.where(valid & (x >= low_fence), x, np.inf).min(axis=0)
+    upper_whisker = np.where(valid & (x <= high_fence), x, -np.inf).max(axis=0)
+    outlier = valid & ((x < lower_whisker) | (x > upper_whisker))
+
+    # histograms: bin index per value, then one bincount over (column, bin) pairs
+    low = np.nanmin(x, axis=0)
+    high = np.nanmax(x, axis=0)
+    width = np.where(high > low, (high - low) / bins, 1.0)
+    bin_idx = np.clip(np.floor((np.where(valid, x, low) - low) / width), 0, bins - 1).astype(np.int64)
+    flat = (np.arange(x.shape[1]) * bins + bin_idx)[valid]
+    bin_counts = np.bincount(flat, minlength=x.shape[1] * bins).reshape(x.shape[1], bins)
+
+    summaries = {}
+    for j, column in enumerate(numeric.columns):
+        summaries[column] = Summary(
+            count=int(valid[:, j].sum()),
+            mean=float(np.nanmean(x[:, j])),
+            q1=float(q1[j]), median=float(median[j]), q3=float(q3[j]),
+            lower_whisker=float(lower_whisker[j]), upper_whisker=float(upper_whisker[j]),
+            outliers=x[outlier[:, j], j].astype(np.float32),
+            bin_edges=low[j] + width[j] * np.arange(bins + 1),
+            bin_counts=bin_counts[j])
+    return summaries
@@ -0,0 +1,49 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    '''Run from the repository root with every store and cache directory under tmp_path.'''
+    import cluster_model
+    import datastore
+    import kmeans
+    import spatial_join
+    import spatial_stats
+    import tiles
+    monkeypatch.chdir(ROOT)
+    monkeypatch.setattr(datastore, 'STORE_DIR', str(tmp_path))
+    monkeypatch.setattr(kmeans, 'CACHE_DIR', str(tmp_path / 'kmeans'))
+    monkeypatch.setattr(cluster_model, 'MODEL_PATH', str(tmp_path / 'cluster_model.json'))
+    monkeypatch.setattr(spatial_join, 'INDEX_DIR', str(tmp_path / 'spatial'))
+    monkeypatch.setattr(tiles, 'TILE_DIR', str(tmp_path / 'tiles'))
+    monkeypatch.setattr(spatial_stats, 'WEIGHTS_DIR', str(tmp_path / 'weights'))
+    return tmp_path
+
+
+@pytest.fixture
+def tracts(tmp_path):
+    '''Small synthetic tract file: a 30 x 20 grid of 0.05 degree squares in Kansas
+    and a 6 x 2 grid straddling the antimeridian, with GEOID ids.'''
+    import geopandas as gpd
+    import shapely
+
+    def grid(lon, lat, columns, rows, size, first):
+        boxes = [shapely.box(lon + i * size, lat + j * size, lon + (i + 1) * size, lat + (j + 1) * size)
+                 for j in range(rows) for i in range(columns)]
+        ids = [f'{first + k:011d}' for k in range(len(boxes))]
+        return ids, boxes
+
+    kansas = grid(-98.0, 38.0, 30, 20, 0.05, 20_000_000_000)
+    aleutians = [grid(lon, 52.0, 3, 2, 0.25, first) for lon, first in
+                 ((179.25, 2_016_000_000), (-180.0, 2_016_000_100))]
+    ids = kansas[0] + [i for part in aleutians for i in part[0]]
+    boxes = kansas[1] + [b for part in aleutians for b in part[1]]
+    path = tmp_path / 'tracts.gpkg'
+    gpd.GeoDataFrame({'GEOID': ids}, geometry=boxes, crs='EPSG:4326').to_file(path)
+    return str(path)
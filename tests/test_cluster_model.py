@@ -0,0 +1,36 @@
+import numpy as np
+
+from cluster_model import ClusterModel, load_or_fit
+from datastore import load_table
+from kmeans import NUMERIC_FEATURES
+
+
+def test_update_with_unchanged_table_scores_nothing(store):
+    # the stored table is float32 and has a missing value (Rio Arriba, 35039)
+    data = load_table('Input files/final_data.csv')
+    assert data[NUMERIC_FEATURES].isna().any().any()
+    model = ClusterModel.fit(data, 7)
+    result = model.update(data)
+    assert len(result.scored) == 0
+    assert not result.needs_refit
+
+
+def test_load_or_fit_refits_only_once(store):
+    data = load_table('Input files/final_data.csv')
+    assert load_or_fit(data, 7)[1]
+    assert not load_or_fit(data, 7)[1]
+    assert not load_or_fit(data, 7)[1]
+
+
+def test_small_change_is_scored_without_refit(store):
+    data = load_table('Input files/final_data.csv')
+    model, _ = load_or_fit(data, 7)
+    changed = data.copy()
+    rows = np.random.default_rng(0).choice(len(changed), 20, replace=False)
+    for column in NUMERIC_FEATURES:
+        values = changed[column].to_numpy().copy()
+        values[rows] *= 1.05
+        changed[column] = values
+    result = model.update(changed)
+    assert len(result.scored) == 20
+    assert not result.needs_refit
@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from datastore import load_frame
+from ingest import STATION_COLUMNS, refresh
+
+
+@pytest.fixture
+def export(tmp_path):
+    '''Raw station export with several chargers per address and a few non-electric stations.'''
+    rng = np.random.default_rng(0)
+    n = 200
+    frame = pd.DataFrame({
+        'ID': np.arange(n),
+        'Fuel Type Code': np.where(np.arange(n) % 10 == 0, 'CNG', 'ELEC'),
+        'Station Name': 'Station',
+        'Street Address': [f'{i % 60} Main St' for i in range(n)],
+        'City': 'Topeka',
+        'State': np.where(np.arange(n) % 60 < 30, 'KS', 'MO'),
+        'ZIP': '66603',
+        'EV Network': np.where(np.arange(n) % 3 == 0, 'Tesla', 'ChargePoint Network'),
+        'EV DC Fast Count': rng.choice([np.nan, 2], n),
+        'EV Level1 EVSE Num': rng.choice([np.nan, 1], n),
+        'EV Level2 EVSE Num': rng.integers(0, 4, n),
+        'Latitude': 39.05,
+        'Longitude': -95.68,
+        'Updated At': '2023-01-01',
+    })[STATION_COLUMNS]
+    path = tmp_path / 'stations.csv'
+    frame.to_csv(path, index=False)
+    return str(path), frame[frame['Fuel Type Code'] == 'ELEC']
+
+
+def test_chunked_refresh_matches_one_pass(store, export):
+    path, stations = export
+    refresh(path, chunksize=10_000)
+    whole = load_frame('charger_locations')
+    # a second refresh finds every station unchanged
+    assert refresh(path, chunksize=7) == 0
+    chunked = load_frame('charger_locations')
+    key = ['Street Address', 'City', 'EV Network']
+    pd.testing.assert_frame_equal(chunked.sort_values(key, ignore_index=True),
+                                  whole.sort_values(key, ignore_index=True))
+    assert len(whole) == stations.groupby(key).ngroups
+    assert len(load_frame('stations')) == len(stations)
+
+
+def test_snapshot_counts_stations_before_dedup(store, export):
+    path, stations = export
+    refresh(path, chunksize=7)
+    snapshot = load_frame('charger_snap').set_index('State')
+    assert snapshot['Total'].to_dict() == stations['State'].value_counts().to_dict()
+    assert snapshot['Tesla'].sum() == (stations['EV Network'] == 'Tesla').sum()
@@ -0,0 +1,19 @@
+import numpy as np
+
+from kmeans import elbow, fit
+
+
+def test_elbow_of_a_sharp_bend():
+    ks = range(1, 11)
+    sse = [100, 40, 12, 10, 9, 8, 7, 6, 5, 4]
+    assert elbow(ks, sse) == 3
+
+
+def test_fit_finds_separated_clusters():
+    rng = np.random.default_rng(0)
+    centres = np.array([[0, 0], [10, 0], [0, 10]])
+    x = np.concatenate([c + rng.normal(size=(50, 2)) for c in centres])
+    result = fit(x, 3)
+    assert len(np.unique(result.labels)) == 3
+    # every blob ends up in one cluster
+    assert all(len(np.unique(result.labels[i * 50:(i + 1) * 50])) == 1 for i in range(3))
@@ -0,0 +1,24 @@
+import numpy as np
+import pandas as pd
+
+from spatial_join import AREA_AGG, aggregate_by_area
+
+
+def test_network_lists_match_a_per_group_join():
+    rng = np.random.default_rng(0)
+    n = 500
+    locations = pd.DataFrame({
+        'FIPS': rng.choice(['20177', '29095', '20091', None], n),
+        'EV Network': rng.choice(['Tesla', 'ChargePoint Network', 'Blink Network', None], n),
+        'EV DC Fast Count': rng.integers(0, 3, n),
+        'EV Level1 EVSE Num': rng.integers(0, 3, n),
+        'EV Level2 EVSE Num': rng.integers(0, 5, n),
+    })
+    for column in ['Station Name', 'City', 'Street Address', 'State', 'ZIP', 'Latitude', 'Longitude']:
+        if column in AREA_AGG:
+            locations[column] = 'x' if column not in ('Latitude', 'Longitude') else 0.0
+    per_area = aggregate_by_area(locations, 'FIPS').set_index('FIPS')
+    expected = (locations.dropna(subset=['FIPS', 'EV Network']).groupby('FIPS')['EV Network']
+                .agg(lambda names: ', '.join(names.unique())))
+    assert per_area['EV Network'].to_dict() == expected.to_dict()
+    assert per_area['EV Level2 EVSE Num'].sum() == locations.dropna(subset=['FIPS'])['EV Level2 EVSE Num'].sum()
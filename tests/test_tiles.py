@@ -0,0 +1,85 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+
+from figures import tract_deck
+from geometry import CountyGeometry
+from tiles import DETAIL_ZOOM, TILE_ZOOMS, View, fit_view, has_field, load_tileset, to_world
+
+
+@pytest.fixture
+def tileset(store, tracts):
+    return load_tileset(tracts, 'GEOID')
+
+
+def _values(tileset):
+    ids = tileset.ids.astype(str)
+    return pd.Series(np.arange(len(ids), dtype=np.float64), index=ids)
+
+
+def test_has_field(store, tracts):
+    assert has_field(tracts, 'GEOID')
+    assert not has_field('Input files/map.gpkg', 'GEOID')
+
+
+def test_tiles_are_built_once_and_memory_mapped(store, tracts, tileset):
+    assert len(tileset.ids) == 612
+    again = load_tileset(tracts, 'GEOID')
+    assert isinstance(again.points, np.memmap)
+    assert list(again.bands) == list(TILE_ZOOMS)
+
+
+def test_polygons_in_view(tileset):
+    values = _values(tileset)
+    view = View(-97.25, 38.5, 10, 700, 500)
+    polygons = tileset.polygons(view, values)
+    assert len(polygons) == 600
+    assert polygons['id'].str.startswith('2000').all()
+    assert (polygons['value'] == values.reindex(polygons['id']).to_numpy()).all()
+    # zoomed out, the tracts are binned into hexagons instead
+    assert tileset.polygons(view._replace(zoom=DETAIL_ZOOM - 1), values) is None
+
+
+def test_hexagons_tile_the_map(tileset):
+    values = _values(tileset)
+    view = View(-97.25, 38.5, 6, 700, 500)
+    hexagons = tileset.hexagons(view, values)
+    assert hexagons['areas'].sum() == 600
+    assert hexagons['value'].sum() == values.iloc[:600].sum()
+    # regular in web mercator: same area everywhere and no overlaps
+    outlines = shapely.polygons([np.stack(to_world(*np.array(p).T), axis=1) for p in hexagons['polygon']])
+    areas = shapely.area(outlines)
+    assert np.allclose(areas, areas[0], rtol=1e-3)
+    assert shapely.area(shapely.union_all(outlines)) == pytest.approx(areas.sum(), rel=1e-3)
+
+
+def test_views_across_the_antimeridian(tileset):
+    values = _values(tileset)
+    view = View(180.0, 52.25, 8, 700, 500)
+    polygons = tileset.polygons(view, values)
+    assert sorted(polygons['id']) == sorted(tileset.ids[600:].astype(str))
+    hexagons = tileset.hexagons(view._replace(zoom=5), values)
+    assert hexagons['areas'].sum() == 12
+    # hexagons of both sides are drawn next to each other, not a world apart
+    longitudes = np.concatenate([np.array(p)[:, 0] for p in hexagons['polygon']])
+    assert np.ptp(longitudes) < 5
+
+
+def test_alaska_view_fits_the_slider():
+    counties = CountyGeometry(json.load(open('Input files/counties.json')))
+    bounds = counties.state_bounds('02')
+    assert bounds[2] - bounds[0] < 60
+    view = fit_view(bounds, 700, 500, min_zoom=3.0, max_zoom=12.0)
+    assert 3.0 <= view.zoom <= 5.0
+    assert -170 < view.longitude < -150
+
+
+def test_tract_deck_layers(tileset):
+    values = _values(tileset)
+    zoomed_in = json.loads(tract_deck(tileset, View(-97.25, 38.5, 10, 700, 500), values, 'chargers').to_json())
+    zoomed_out = json.loads(tract_deck(tileset, View(-97.25, 38.5, 5, 700, 500), values, 'chargers').to_json())
+    assert [layer['id'] for layer in zoomed_in['layers']] == ['tracts']
+    assert [layer['id'] for layer in zoomed_out['layers']] == ['tract_hexagons']
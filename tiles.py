@@ -0,0 +1,279 @@
+#web mercator tiles of small-area polygons (census tracts) for the deck.gl map
+import hashlib
+import os
+import shutil
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from datastore import STORE_DIR, temp_path
+from geometry import PackedGeometry, quantize, simplify
+from instrumentation import count_cache
+from spatial_join import read_polygons
+
+
+TILE_DIR = os.path.join(STORE_DIR, 'tiles')
+
+TILE_SIZE = 256
+# zoom levels the polygons are simplified and cut at, a view uses the closest one below its zoom
+TILE_ZOOMS = (6, 8, 10)
+# below this zoom, or with more polygons than MAX_POLYGONS in view, the map shows hexagons
+DETAIL_ZOOM = 7
+MAX_POLYGONS = 15_000
+# simplification tolerance and hexagon radius in screen pixels
+TOLERANCE_PX = 0.5
+HEX_RADIUS_PX = 12
+# extra pixels loaded around the view, so a little panning shows no holes
+MARGIN_PX = 256
+MAX_LATITUDE = 85.05112878
+
+# center, zoom and size in pixels of the map view
+View = namedtuple('View', ['longitude', 'latitude', 'zoom', 'width', 'height'])
+
+
+def to_world(longitude, latitude):
+    '''Web mercator coordinates scaled to [0, 1) (x to the east, y to the south).'''
+    lat = np.radians(np.clip(latitude, -MAX_LATITUDE, MAX_LATITUDE))
+    x = (np.asarray(longitude, dtype=np.float64) + 180) / 360
+    y = (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2
+    return x, y
+
+
+def to_lonlat(x, y):
+    return x * 360 - 180, np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * y))))
+
+
+def fit_zoom(bounds, width, height):
+    '''Zoom level at which (min lon, min lat, max lon, max lat) fills the view.
+
+    max lon may be past 180 for an area that crosses the antimeridian (see
+    geometry.total_bounds).
+    '''
+    x0, y1 = to_world(bounds[0], bounds[1])
+    x1, y0 = to_world(bounds[2], bounds[3])
+    scale = min(width / max(x1 - x0, 1e-9), height / max(y1 - y0, 1e-9)) / TILE_SIZE
+    return float(np.log2(scale))
+
+
+def fit_view(bounds, width, height, min_zoom=0.0, max_zoom=22.0):
+    '''View centred on bounds at the zoom that fits them, kept within min_zoom..max_zoom.'''
+    zoom = min(max(fit_zoom(bounds, width, height), min_zoom), max_zoom)
+    longitude = ((bounds[0] + bounds[2]) / 2 + 180) % 360 - 180
+    return View(longitude, (bounds[1] + bounds[3]) / 2, zoom, width, height)
+
+
+def view_box(view, margin=MARGIN_PX):
+    # world coordinates of the view plus margin, as (x0, y0, x1, y1)
+    x, y = to_world(view.longitude, view.latitude)
+    pixels = TILE_SIZE * 2 ** view.zoom
+    half_x = (view.width / 2 + margin) / pixels
+    half_y = (view.height / 2 + margin) / pixels
+    return x - half_x, y - half_y, x + half_x, y + half_y
+
+
+def hexagon_corners(cx, cy, radius):
+    # the six corners of pointy-top hexagons, as (hexagons, 6) arrays of x and y
+    angles = np.radians(np.arange(6) * 60 - 30)
+    return cx[:, None] + radius * np.cos(angles), cy[:, None] + radius * np.sin(angles)
+
+
+def hexbin(x, y, weights, radius):
+    '''Sum weights into pointy-top hexagons of the given radius (centre to corner).
+
+    Returns the hexagon centres, weight sums and point counts; same layout as
+    d3-hexbin.
+    '''
+    q = (np.sqrt(3) / 3 * x - y / 3) / radius
+    r = 2 / 3 * y / radius
+    s = -q - r
+    rq, rr, rs = np.round(q), np.round(r), np.round(s)
+    dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+    fix_q = (dq > dr) & (dq > ds)
+    fix_r = ~fix_q & (dr > ds)
+    rq = np.where(fix_q, -rr - rs, rq)
+    rr = np.where(fix_r, -rq - rs, rr)
+    cells, inverse = np.unique(np.stack([rq, rr], axis=1), axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    sums = np.bincount(inverse, weights=weights, minlength=len(cells))
+    counts = np.bincount(inverse, minlength=len(cells))
+    cx = radius * np.sqrt(3) * (cells[:, 0] + cells[:, 1] / 2)
+    cy = radius * 1.5 * cells[:, 1]
+    return cx, cy, sums, counts
+
+
+class TileSet:
+    '''Polygons simplified for a few zoom levels and indexed by web mercator tile.
+
+    Every zoom in TILE_ZOOMS keeps one packed copy of the polygons (see
+    geometry.PackedGeometry) and a tile -> polygon index in CSR layout
+    (sorted tile keys, offsets into a member list). Saved as plain .npy
+    files and memory mapped on load, so a view only reads the tiles it
+    covers. Zoomed out views are binned into hexagons from the polygons'
+    representative points instead.
+    '''
+
+    def __init__(self, ids, points, bands):
+        self.ids = ids
+        # representative point of every polygon, as world coordinates
+        self.points = points
+        # zoom -> (packed geometry, tile keys, tile offsets, members)
+        self.bands = bands
+
+    @classmethod
+    def build(cls, ids, geoms, zooms=TILE_ZOOMS):
+        ids = np.asarray(ids).astype(str)
+        px, py = to_world(*shapely.get_coordinates(shapely.point_on_surface(geoms)).T)
+        bands = {}
+        for zoom in zooms:
+            tolerance = TOLERANCE_PX * 360 / (TILE_SIZE * 2 ** zoom)
+            simplified = quantize(geoms, simplify(geoms, tolerance), tolerance / 4)
+            packed = PackedGeometry(ids, simplified, tolerance / 4)
+            bands[zoom] = (packed, *cls._tile_index(shapely.bounds(simplified), zoom))
+        return cls(ids, np.stack([px, py], axis=1), bands)
+
+    @staticmethod
+    def _tile_index(bounds, zoom):
+        n = 2 ** zoom
+        x0, y1 = to_world(bounds[:, 0], bounds[:, 1])
+        x1, y0 = to_world(bounds[:, 2], bounds[:, 3])
+        tx0, tx1 = (np.clip(np.floor(v * n), 0, n - 1).astype(np.int64) for v in (x0, x1))
+        ty0, ty1 = (np.clip(np.floor(v * n), 0, n - 1).astype(np.int64) for v in (y0, y1))
+        # one (tile, polygon) pair for every tile a polygon's bounding box touches
+        width, height = tx1 - tx0 + 1, ty1 - ty0 + 1
+        members = np.repeat(np.arange(len(bounds)), width * height)
+        step = np.arange(len(members)) - np.repeat(np.cumsum(width * height) - width * height, width * height)
+        tx = tx0[members] + step % width[members]
+        ty = ty0[members] + step // width[members]
+        keys = tx * n + ty
+        order = np.argsort(keys, kind='stable')
+        keys, members = keys[order], members[order]
+        tile_keys, starts = np.unique(keys, return_index=True)
+        offsets = np.append(starts, len(keys))
+        return tile_keys, offsets.astype(np.int64), members.astype(np.int32)
+
+    def save(self, path):
+        tmp = temp_path(path)
+        os.makedirs(tmp)
+        np.save(os.path.join(tmp, 'ids.npy'), self.ids)
+        np.save(os.path.join(tmp, 'points.npy'), self.points)
+        for zoom, (packed, keys, offsets, members) in self.bands.items():
+            arrays = {'coords': packed.coords, 'rings': packed.offsets[0], 'polygons': packed.offsets[1],
+                      'geometries': packed.offsets[2], 'keys': keys, 'offsets': offsets, 'members': members,
+                      'decimals': np.array(packed.decimals)}
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp, f'{zoom}_{name}.npy'), array)
+        # rename the finished directory into place, so readers never see a partial
+        # tile set; if another writer got there first, keep its copy
+        try:
+            os.replace(tmp, path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path, zooms=TILE_ZOOMS):
+        def array(name):
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+        ids = array('ids')
+        bands = {}
+        for zoom in zooms:
+            packed = PackedGeometry.from_arrays(ids, array(f'{zoom}_coords'),
+                                                [array(f'{zoom}_{name}') for name in ('rings', 'polygons', 'geometries')],
+                                                int(array(f'{zoom}_decimals')))
+            bands[zoom] = (packed, array(f'{zoom}_keys'), array(f'{zoom}_offsets'), array(f'{zoom}_members'))
+        return cls(ids, array('points'), bands)
+
+    @property
+    def nbytes(self):
+        return self.ids.nbytes + self.points.nbytes + sum(
+            packed.nbytes + keys.nbytes + offsets.nbytes + members.nbytes
+            for packed, keys, offsets, members in self.bands.values())
+
+    def band(self, zoom):
+        # the most detailed tile zoom that is not finer than the view
+        candidates = [z for z in self.bands if z <= zoom]
+        return max(candidates) if candidates else min(self.bands)
+
+    def visible(self, view):
+        '''Tile zoom used for the view and the polygons whose tiles it covers.'''
+        zoom = self.band(view.zoom)
+        _, keys, offsets, members = self.bands[zoom]
+        n = 2 ** zoom
+        x0, y0, x1, y1 = (np.floor(v * n).astype(np.int64) for v in view_box(view))
+        # tile columns wrap around the antimeridian, rows stop at the poles
+        columns = np.unique(np.arange(x0, x1 + 1) % n)
+        rows = np.arange(max(y0, 0), min(y1, n - 1) + 1)
+        tx, ty = np.meshgrid(columns, rows)
+        wanted = (tx * n + ty).ravel()
+        found = np.searchsorted(keys, wanted)
+        hit = found < len(keys)
+        found = found[hit][keys[found[hit]] == wanted[hit]]
+        if not len(found):
+            return zoom, np.empty(0, dtype=np.int64)
+        chunks = [members[offsets[i]:offsets[i + 1]] for i in found]
+        return zoom, np.unique(np.concatenate(chunks))
+
+    def polygons(self, view, values):
+        '''One row per polygon part in view: id, rings and value (NaN when missing).
+
+        None when the view is zoomed out too far or holds more than
+        MAX_POLYGONS polygons; use hexagons() then.
+        '''
+        if view.zoom < DETAIL_ZOOM:
+            return None
+        zoom, indices = self.visible(view)
+        if len(indices) > MAX_POLYGONS:
+            return None
+        packed = self.bands[zoom][0]
+        geometries = packed.offsets[2]
+        rows = [(i, packed.rings(p)) for i in indices for p in range(geometries[i], geometries[i + 1])]
+        index = np.array([i for i, _ in rows], dtype=np.int64)
+        ids = self.ids[index]
+        return pd.DataFrame({'id': ids, 'polygon': [rings for _, rings in rows],
+                             'value': values.reindex(ids).to_numpy(dtype=np.float64)})
+
+    def hexagons(self, view, values):
+        '''Polygons in view binned into hexagons of HEX_RADIUS_PX on screen.
+
+        Each row has the hexagon outline and centre, the summed value, the
+        number of polygons and how many of them have no value or a value of 0.
+        The hexagons are regular in web mercator, like the map, so they tile
+        it without gaps or overlaps at every latitude.
+        '''
+        x0, y0, x1, y1 = view_box(view)
+        # points on the far side of the antimeridian are moved next to the view
+        centre = (x0 + x1) / 2
+        x = (self.points[:, 0] - centre + 0.5) % 1 + centre - 0.5
+        y = self.points[:, 1]
+        inside = np.flatnonzero((x >= x0) & (x <= x1) & (y >= y0) & (y <= y1))
+        weights = values.reindex(self.ids[inside]).to_numpy(dtype=np.float64)
+        empty = ~(weights > 0)
+        radius = HEX_RADIUS_PX / (TILE_SIZE * 2 ** view.zoom)
+        cx, cy, sums, counts = hexbin(x[inside], y[inside], np.nan_to_num(weights), radius)
+        _, _, gaps, _ = hexbin(x[inside], y[inside], empty.astype(np.float64), radius)
+        longitude, latitude = to_lonlat(cx, cy)
+        corners = np.stack(to_lonlat(*hexagon_corners(cx, cy, radius)), axis=2)
+        return pd.DataFrame({'polygon': list(np.round(corners, 5).tolist()), 'longitude': longitude,
+                             'latitude': latitude, 'value': sums, 'areas': counts, 'gaps': gaps.astype(np.int64)})
+
+
+def has_field(source, id_field):
+    import geopandas as gpd
+    return id_field in gpd.read_file(source, rows=1).columns
+
+
+def _tile_path(source, id_field):
+    key = f'{os.path.abspath(source)}:{id_field}:{os.path.getmtime(source)}:{TILE_ZOOMS}'
+    return os.path.join(TILE_DIR, hashlib.sha1(key.encode()).hexdigest())
+
+
+def load_tileset(source, id_field):
+    '''Tile set of a polygon file, cut once and stored under the store directory.'''
+    path = _tile_path(source, id_field)
+    count_cache('tract_tiles', hit=os.path.exists(path))
+    if not os.path.exists(path):
+        TileSet.build(*read_polygons(source, id_field)).save(path)
+    return TileSet.load(path)